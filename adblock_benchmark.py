@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2018 Andy Stewart
+#
+# Author:     Andy Stewart <lazycat.manatee@gmail.com>
+# Maintainer: Andy Stewart <lazycat.manatee@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Replay a corpus of requests against the adblock engine, without Qt and network.
+#
+# Corpus has one request per line: url, source url and request type separated by tab,
+# save one from browser with `save_adblock_corpus', it's written to
+# ~/.emacs.d/eaf/browser/adblock/corpus.txt
+#
+# Usage:
+#     python3 adblock_benchmark.py corpus.txt
+#     python3 adblock_benchmark.py corpus.txt --rules easylist.txt easyprivacy.txt --repeat 5
+
+import argparse
+import os
+import sys
+import time
+
+found_braveblock = True
+try:
+    import braveblock
+except:
+    found_braveblock = False
+found_adblock = True
+try:
+    import adblock
+except:
+    found_adblock = False
+
+def build_engine(rules_paths):
+    raw_rules_list = []
+    for rules_path in rules_paths:
+        with open(rules_path, encoding="utf-8", errors="ignore") as f:
+            raw_rules_list.append(f.read())
+
+    if found_adblock:
+        filter_set = adblock.FilterSet()
+        for raw_rules in raw_rules_list:
+            filter_set.add_filter_list(raw_rules)
+        engine = adblock.Engine(filter_set)
+        return lambda url, source_url, request_type: engine.check_network_urls(url, source_url, request_type).matched
+    else:
+        rules = []
+        for raw_rules in raw_rules_list:
+            rules += raw_rules.splitlines()
+        engine = braveblock.Adblocker(rules=rules)
+        return lambda url, source_url, request_type: engine.check_network_urls(
+            url=url, source_url=source_url, request_type=request_type)
+
+def read_corpus(corpus_path):
+    requests = []
+    with open(corpus_path, encoding="utf-8") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if fields[0] != "":
+                fields += [""] * (3 - len(fields))
+                requests.append(tuple(fields[:3]))
+    return requests
+
+def percentile(sorted_latencies, percent):
+    index = min(len(sorted_latencies) - 1, int(len(sorted_latencies) * percent / 100))
+    return sorted_latencies[index]
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay request corpus against EAF Browser adblock engine.")
+    parser.add_argument("corpus", help="corpus file, url<TAB>source url<TAB>request type per line")
+    parser.add_argument("--rules", nargs="+",
+                        default=[os.path.join(os.path.dirname(os.path.abspath(__file__)), "easylist.txt")],
+                        help="filter lists, default is easylist.txt of EAF Browser")
+    parser.add_argument("--repeat", type=int, default=3, help="times to replay corpus")
+    args = parser.parse_args()
+
+    if not (found_adblock or found_braveblock):
+        sys.exit("Please install python-adblock or braveblock first.")
+
+    start_time = time.perf_counter()
+    check = build_engine(args.rules)
+    build_time = time.perf_counter() - start_time
+
+    requests = read_corpus(args.corpus)
+    if len(requests) == 0:
+        sys.exit("Corpus {} is empty.".format(args.corpus))
+
+    latencies = []
+    blocked = 0
+    start_time = time.perf_counter()
+    for _ in range(args.repeat):
+        for (url, source_url, request_type) in requests:
+            request_start_time = time.perf_counter()
+            try:
+                block = check(url, source_url, request_type)
+            except Exception:
+                block = False
+            latencies.append(time.perf_counter() - request_start_time)
+            blocked += block
+    replay_time = time.perf_counter() - start_time
+    latencies.sort()
+
+    print("Engine: {}".format("python-adblock" if found_adblock else "braveblock"))
+    print("Rules: {}".format(", ".join(args.rules)))
+    print("Build time: {:.3f}s".format(build_time))
+    print("Requests: {} x {}, blocked: {:.1f}%".format(len(requests), args.repeat, blocked * 100 / len(latencies)))
+    print("Throughput: {:.0f} requests/s".format(len(latencies) / replay_time))
+    print("Latency p50: {:.1f}us, p99: {:.1f}us, max: {:.1f}us".format(
+        percentile(latencies, 50) * 1000000,
+        percentile(latencies, 99) * 1000000,
+        latencies[-1] * 1000000))
+
+if __name__ == "__main__":
+    main()
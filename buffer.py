@@ -19,50 +19,63 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import array
+import bisect
+import heapq
+import json
 import os
 import re
 import threading
 import time
 import urllib
+import weakref
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 
 from core.utils import *
 from core.webengine import BrowserBuffer
-from PyQt6.QtCore import QUrl, pyqtSlot
+from PyQt6.QtCore import QTimer, QUrl, pyqtSlot
 from PyQt6.QtGui import QColor
-from PyQt6.QtWebEngineCore import QWebEngineUrlRequestInterceptor
+from PyQt6.QtWebEngineCore import QWebEngineScript, QWebEngineUrlRequestInfo, QWebEngineUrlRequestInterceptor
 found_braveblock = True
 try:
     import braveblock
 except:
     found_braveblock = False
+# python-adblock wraps the same adblock-rust engine, and can serialize compiled engine.
+found_adblock = True
+try:
+    import adblock
+except:
+    found_adblock = False
 
 class AppBuffer(BrowserBuffer):
+    # Milliseconds between two position reports to Emacs.
+    POSITION_REPORT_INTERVAL = 16
+
+    # Milliseconds to wait for result of run_js_async.
+    JS_TIMEOUT = 10000
+
     def __init__(self, buffer_id, url, arguments):
         BrowserBuffer.__init__(self, buffer_id, url, arguments, False)
 
-        self.config_dir = get_emacs_config_dir()
+        # Emacs doesn't push config changes when no browser buffer is live, read them again.
+        if len(BufferLifecycleManager.get().buffers) == 0:
+            BrowserConfig.reset()
 
-        # When arguments is "temp_html_file", browser will load content of html file, then delete temp file.
-        # Usually use for render html mail.
-        if arguments == "temp_html_file":
-            with open(url, "r") as html_file:
-                self.buffer_widget.setHtml(html_file.read())
-                if os.path.exists(url):
-                    os.remove(url)
-        else:
-            if arguments in ["pc", "phone"]:
-                self.set_agent(arguments)
-
-            self.buffer_widget.setUrl(QUrl(url))
+        self.config_dir = get_emacs_config_dir()
 
         # Init emacs vars.
         (self.dark_mode_var,
          self.remember_history, self.blank_page_url,
-         self.enable_adblocker, self.enable_autofill,
+         self.enable_adblocker, self.adblock_filter_lists, self.enable_autofill,
          self.enable_tampermonkey, self.tampermonkey_script_location,
          self.aria2_auto_file_renaming, self.aria2_proxy_host, self.aria2_proxy_port,
          self.chrome_history_file,
          self.safari_history_file,
+         self.firefox_history_file,
+         self.history_sync_browsers,
+         self.history_sync_interval,
          self.translate_language,
          self.text_selection_color,
          self.dark_mode_theme,
@@ -73,6 +86,7 @@ class AppBuffer(BrowserBuffer):
              "eaf-browser-remember-history",
              "eaf-browser-blank-page-url",
              "eaf-browser-enable-adblocker",
+             "eaf-browser-adblock-filter-lists",
              "eaf-browser-enable-autofill",
              "eaf-browser-enable-tampermonkey",
              "eaf-browser-tampermonkey-location",
@@ -81,6 +95,9 @@ class AppBuffer(BrowserBuffer):
              "eaf-browser-aria2-proxy-port",
              "eaf-browser-chrome-history-file",
              "eaf-browser-safari-history-file",
+             "eaf-browser-firefox-history-file",
+             "eaf-browser-history-sync-browsers",
+             "eaf-browser-history-sync-interval",
              "eaf-browser-translate-language",
              "eaf-browser-text-selection-color",
              "eaf-browser-dark-mode-theme",
@@ -88,27 +105,41 @@ class AppBuffer(BrowserBuffer):
              "eaf-browser-chrome-browser-name"
          ])
 
-        self.load_tampermonkey(url)
+        # Time of our own hooks for next page load, see PageLoadTimeline.
+        self.page_load = None
+        self.page_load_hooks = {}
 
-        # Use thread to avoid slow down open speed.
-        threading.Thread(target=self.load_history).start()
+        # Register userscripts before first navigation, so document-start scripts don't miss the page.
+        with self.timed_hook("userscripts"):
+            self.load_tampermonkey()
 
-        self.autofill = PasswordDb(os.path.join(os.path.dirname(self.config_dir), "browser", "password.db"))
-        self.pw_autofill_id = 0
-        self.pw_autofill_raw = None
+        # Same for Dark Reader, page is dark from its first paint.
+        self.dark_mode_installed = None
+        self.dark_mode_css_installed = None
+        self.init_dark_mode()
+        if arguments != "temp_html_file":
+            self.install_dark_mode(QUrl(url))
+        if hasattr(self.buffer_widget.web_page, "loadingChanged"):
+            self.buffer_widget.web_page.loadingChanged.connect(self.update_dark_mode_on_loading)
+        self.buffer_widget.urlChanged.connect(self.install_dark_mode)
 
-        self.readability_js = None
+        # When arguments is "temp_html_file", browser will load content of html file, then delete temp file.
+        # Usually use for render html mail.
+        if arguments == "temp_html_file":
+            with open(url, "r") as html_file:
+                self.buffer_widget.setHtml(html_file.read())
+                if os.path.exists(url):
+                    os.remove(url)
+        else:
+            if arguments in ["pc", "phone"]:
+                self.set_agent(arguments)
 
-        self.buffer_widget.init_dark_mode_js(__file__,
-                                             self.text_selection_color,
-                                             self.dark_mode_theme,
-                                             {
-                                                 "brightness": 100,
-                                                 "constrast": 90,
-                                                 "sepia": 10,
-                                                 "mode": 0,
-                                                 "darkSchemeBackgroundColor": get_emacs_theme_background(),
-                                                 "darkSchemeForegroundColor": get_emacs_theme_foreground()})
+            self.buffer_widget.setUrl(QUrl(url))
+
+        self.load_history()
+
+        self.autofill = PasswordDb.get(os.path.join(os.path.dirname(self.config_dir), "browser", "password.db"))
+        self.pw_autofill_id = 0
 
         self.close_page.connect(self.record_close_page)
 
@@ -123,8 +154,13 @@ class AppBuffer(BrowserBuffer):
         # Record url when url changed.
         self.buffer_widget.urlChanged.connect(self.update_url)
 
+        # Results of js run for previous page are stale.
+        self.js_requests = set()
+        self.buffer_widget.urlChanged.connect(lambda url: self.cancel_js_requests())
+
         # Draw progressbar.
-        self.caret_browsing_js_raw = None
+        self.caret_browsing_js = None
+        self.caret_browsing_colors_installed = None
         self.progressbar_progress = 0
         self.progressbar_height = int(get_emacs_var("eaf-browser-progress-bar-height"))
         self.progressbar_color = QColor(get_emacs_var("eaf-browser-progress-bar-color"))
@@ -132,8 +168,14 @@ class AppBuffer(BrowserBuffer):
         self.buffer_widget.loadProgress.connect(self.update_progress)
         self.is_loading = False
 
-        # Update page position
-        self.buffer_widget.web_page.scrollPositionChanged.connect(self.update_position)
+        # Update page position, at most once per frame interval.
+        self.position_report = None
+        self.position_pending = False
+        self.position_timer = QTimer(self)
+        self.position_timer.setSingleShot(True)
+        self.position_timer.setInterval(self.POSITION_REPORT_INTERVAL)
+        self.position_timer.timeout.connect(self.flush_position)
+        self.buffer_widget.web_page.scrollPositionChanged.connect(self.schedule_update_position)
 
         # Reset to default zoom when page init or page url changed.
         self.reset_default_zoom()
@@ -146,10 +188,24 @@ class AppBuffer(BrowserBuffer):
         self.buffer_widget.create_new_window = self.create_new_window
 
         self.start_loading_time = 0
+        self.first_load_finished = False
+
+        # Freeze and discard page after it's hidden for a while.
+        self.discarded_snapshot = None
+        BufferLifecycleManager.get().register(self)
 
-        if found_braveblock and self.enable_adblocker:
+        if (found_adblock or found_braveblock) and self.enable_adblocker:
             self.interceptor = AdBlockInterceptor(self.profile, self)
 
+            # Update element hiding stylesheet when navigation starts, before new document is created.
+            self.cosmetic_filter_key = None
+            if hasattr(self.buffer_widget.web_page, "loadingChanged"):
+                self.buffer_widget.web_page.loadingChanged.connect(self.update_cosmetic_filter_on_loading)
+            self.buffer_widget.urlChanged.connect(self.update_cosmetic_filter)
+        else:
+            # Generic stylesheet is registered in the shared profile by buffers created with adblocker on.
+            AdBlockManager.uninstall_cosmetic_filter(self.profile)
+
         if self.auto_import_chrome_cookies:
             # import cookies from Chrome automatically
             self.import_chrome_cookies(url)
@@ -167,13 +223,12 @@ class AppBuffer(BrowserBuffer):
             qcookie.setDomain(urlparse(url).netloc)
             cookieStore.setCookie(qcookie, QUrl())
 
-    def load_tampermonkey(self,url):
+    def load_tampermonkey(self):
         if self.enable_tampermonkey:
             try:
-                for filepath in os.listdir(self.tampermonkey_script_location):
-                    script = TampermonkeyScript(os.path.join(self.tampermonkey_script_location,filepath))
-                    if script.can_run(url):
-                        self.buffer_widget.eval_js(script.content())
+                registry = TampermonkeyRegistry.get(self.tampermonkey_script_location)
+                registry.refresh()
+                registry.install(self.profile)
             except FileNotFoundError:
                 message_to_emacs(f"{self.tampermonkey_script_location} is not found!")
 
@@ -187,6 +242,11 @@ class AppBuffer(BrowserBuffer):
                  "eaf-browser-text-selection-color",
                  "eaf-browser-dark-mode-theme"])
 
+        # Apply new theme to current page without reloading it.
+        self.init_dark_mode()
+        self.install_dark_mode(self.buffer_widget.url(), live=True)
+
+    def init_dark_mode(self):
         self.buffer_widget.init_dark_mode_js(__file__,
                                              self.text_selection_color,
                                              self.dark_mode_theme,
@@ -198,28 +258,106 @@ class AppBuffer(BrowserBuffer):
                                                  "darkSchemeBackgroundColor": get_emacs_theme_background(),
                                                  "darkSchemeForegroundColor": get_emacs_theme_foreground()})
 
-        self.refresh_page()
+        # Dark Reader js includes theme, generated css is cached per origin and this key.
+        import hashlib
+        self.dark_mode_theme_key = hashlib.sha1(self.buffer_widget.dark_mode_js.encode("utf-8")).hexdigest()
+
+    def dark_mode_js_load(self, progress):
+        ''' Dark Reader is registered at document creation, nothing to inject while page loads. '''
+        self.install_dark_mode(self.buffer_widget.url())
+
+    def update_dark_mode_on_loading(self, loading_info):
+        if loading_info.status() == loading_info.LoadStatus.LoadStartedStatus:
+            with self.timed_hook("dark_mode"):
+                self.install_dark_mode(loading_info.url())
+
+    def install_dark_mode(self, url, live=False):
+        ''' Register Dark Reader and cached css of url's origin in page, both run at document creation.
+
+        With live, current page switches to new dark mode setting and theme without reload.
+        '''
+        enabled = self.dark_mode_is_enabled() and url.scheme() != "devtools"
+        page_scripts = self.buffer_widget.web_page.scripts()
+
+        if self.dark_mode_installed != (enabled, self.dark_mode_theme_key):
+            for script in page_scripts.find(DarkModeCssCache.darkreader_script_name):
+                page_scripts.remove(script)
+            if enabled:
+                script = QWebEngineScript()
+                script.setName(DarkModeCssCache.darkreader_script_name)
+                script.setSourceCode(self.buffer_widget.dark_mode_js)
+                script.setInjectionPoint(QWebEngineScript.InjectionPoint.DocumentCreation)
+                script.setWorldId(QWebEngineScript.ScriptWorldId.MainWorld)
+                script.setRunsOnSubFrames(False)
+                page_scripts.insert(script)
+
+            if live:
+                self.buffer_widget.eval_js("if (window.DarkReader) { DarkReader.disable(); }")
+                if enabled:
+                    self.buffer_widget.eval_js(self.buffer_widget.dark_mode_js)
+            self.dark_mode_installed = (enabled, self.dark_mode_theme_key)
+
+        # Css of last visit is shown until Dark Reader has styled the page, no white flash on revisit.
+        css_key = (DarkModeCssCache.origin(url), self.dark_mode_theme_key)
+        css = DarkModeCssCache.styles.get(css_key) if enabled else None
+        if self.dark_mode_css_installed == (css_key, css is not None):
+            return
+        self.dark_mode_css_installed = (css_key, css is not None)
+
+        for script in page_scripts.find(DarkModeCssCache.css_script_name):
+            page_scripts.remove(script)
+        if css is not None:
+            script = style_script(DarkModeCssCache.css_script_name, "eaf-dark-mode-cached", css,
+                                  prelude="if (location.origin !== {}) return;".format(json.dumps(DarkModeCssCache.origin(url))),
+                                  epilogue='''window.addEventListener("load", function() {
+    setTimeout(function() { style.remove(); }, 1000);
+});''')
+            script.setRunsOnSubFrames(False)
+            page_scripts.insert(script)
+
+    def cache_dark_mode_css(self):
+        ''' Save css generated by Dark Reader for page's origin, used when origin is visited again. '''
+        if not (self.dark_mode_installed and self.dark_mode_installed[0]):
+            return
+
+        url = self.buffer_widget.url()
+        key = (DarkModeCssCache.origin(url), self.dark_mode_theme_key)
+        if key[0] is None or DarkModeCssCache.styles.get(key) is not None:
+            return
+
+        # exportGeneratedCSS returns promise, read its result after it settles.
+        self.buffer_widget.eval_js("if (window.DarkReader) { DarkReader.exportGeneratedCSS().then(function(css) { window.eafDarkModeCss = css; }); }")
+
+        def read_css():
+            try:
+                self.buffer_widget.web_page.runJavaScript(
+                    "window.eafDarkModeCss || null;",
+                    QWebEngineScript.ScriptWorldId.MainWorld.value,
+                    lambda css: DarkModeCssCache.styles.put(key, css) if css else None)
+            except RuntimeError:
+                # Buffer is killed.
+                pass
+
+        QTimer.singleShot(DarkModeCssCache.EXPORT_DELAY, read_css)
 
     def load_history(self):
-        self.history_list = []
+        self.history_store = None
         if self.remember_history:
             self.history_log_file_path = os.path.join(self.config_dir, "browser", "history", "log.txt")
-
-            self.history_pattern = re.compile(r"^(.+)ᛝ(.+)ᛡ(.+)$")
-            self.noprefix_url_pattern = re.compile(r"^(https?|file)://(.+)")
-            self.nopostfix_url_pattern = re.compile(r"^[^#\?]*")
             self.history_close_file_path = os.path.join(self.config_dir, "browser", "history", "close.txt")
-            touch(self.history_log_file_path)
-            with open(self.history_log_file_path, "r", encoding="utf-8") as f:
-                raw_list = f.readlines()
-                for raw_his in raw_list:
-                    his_line = re.match(self.history_pattern, raw_his)
-                    if his_line is None: # Obsolete Old history format
-                        old_his = re.match(r"(.*)\s((https?|file):[^\s]+)$", raw_his)
-                        if old_his is not None:
-                            self.history_list.append(HistoryPage(old_his.group(1), old_his.group(2), 1))
-                    else:
-                        self.history_list.append(HistoryPage(his_line.group(1), his_line.group(2), his_line.group(3)))
+
+            # Shared by all browser buffers, loaded by background thread to avoid slow down open speed.
+            self.history_store = HistoryStore.get(self.history_log_file_path)
+            if self.history_store.ignore_matcher is None:
+                self.history_store.set_ignore_history_list(BrowserConfig.get("eaf-browser-ignore-history-list") or [])
+
+            if self.history_sync_browsers and self.history_sync_interval:
+                sources = []
+                for browser_name in self.history_sync_browsers:
+                    if browser_name in HistoryImporter.sync_browsers:
+                        sources.append((browser_name, os.path.expanduser({"chrome": self.chrome_history_file,
+                                                                          "firefox": self.firefox_history_file}[browser_name])))
+                HistoryImporter.start_sync(HistoryImporter(self.history_store, self.config_dir), sources, float(self.history_sync_interval))
 
         self.buffer_widget.titleChanged.connect(self.record_history)
 
@@ -238,16 +376,22 @@ class AppBuffer(BrowserBuffer):
 
         self.start_loading_time = time.time()
 
+        # Hooks run at navigation start are timed into page_load_hooks already.
+        self.page_load = PageLoad(self.buffer_id, self.buffer_widget.url().toString(), self.page_load_hooks)
+        if hasattr(self, "interceptor"):
+            self.page_load.adblock_start = self.interceptor.counts()
+
         self.progressbar_progress = 0
         self.update()
 
     @pyqtSlot(int)
     def update_progress(self, progress):
         ''' Update the Progress Bar.'''
-        self.dark_mode_js_load(progress)
-
         self.progressbar_progress = progress
 
+        if self.page_load is not None and self.page_load.first_progress is None and progress > 0:
+            self.page_load.first_progress = time.time() - self.page_load.start_time
+
         if progress < 100:
             # Update progress.
             self.caret_js_ready = False
@@ -258,42 +402,128 @@ class AppBuffer(BrowserBuffer):
             if self.is_loading:
                 self.is_loading = False
 
-            self.buffer_widget.load_marker_file()
+            with self.timed_hook("marker"):
+                self.buffer_widget.load_marker_file()
+
+            with self.timed_hook("caret"):
+                self.install_caret_browsing_js()
+            self.caret_js_ready = True
 
-            cursor_foreground_color = ""
-            cursor_background_color = ""
+            self.after_page_load_hook() # Run after page load hook
 
-            if self.caret_browsing_js_raw is None:
-                self.caret_browsing_js_raw = self.buffer_widget.read_js_content("caret_browsing.js")
+            self.finish_page_load()
 
-            self.caret_browsing_js = self.caret_browsing_js_raw.replace("%1", cursor_foreground_color).replace("%2", cursor_background_color)
-            self.buffer_widget.eval_js(self.caret_browsing_js)
-            self.caret_js_ready = True
+    @contextmanager
+    def timed_hook(self, name):
+        ''' Add time spent in with block to hook name of current page load. '''
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.page_load_hooks[name] = self.page_load_hooks.get(name, 0) + time.perf_counter() - start_time
 
-            if self.dark_mode_is_enabled():
-                if self.dark_mode_var == "follow":
-                    cursor_foreground_color = self.theme_foreground_color
-                    cursor_background_color = self.theme_background_color
-                else:
-                    cursor_foreground_color = "#FFF"
-                    cursor_background_color = "#000"
-            else:
-                if self.dark_mode_var == "follow":
-                    cursor_foreground_color = self.theme_foreground_color
-                    cursor_background_color = self.theme_background_color
-                else:
-                    cursor_foreground_color = "#000"
-                    cursor_background_color = "#FFF"
+    def finish_page_load(self):
+        page_load = self.page_load
+        if page_load is None or page_load.load_time is not None:
+            return
 
-            self.after_page_load_hook() # Run after page load hook
+        page_load.url = self.buffer_widget.url().toString()
+        page_load.load_time = time.time() - page_load.start_time
+        if hasattr(self, "interceptor"):
+            (blocked, allowed) = self.interceptor.counts()
+            (start_blocked, start_allowed) = page_load.adblock_start or (0, 0)
+            (page_load.blocked, page_load.allowed) = (blocked - start_blocked, allowed - start_allowed)
+        PageLoadTimeline.add(page_load)
+
+        # Hooks from now on belong to next navigation.
+        self.page_load_hooks = {}
+
+        def read_timing(timing):
+            if timing:
+                page_load.dom_content_loaded = timing["domContentLoaded"] / 1000
+                page_load.load_event = timing["load"] / 1000
+
+        self.run_js_async(PageLoadTimeline.timing_js, read_timing, QWebEngineScript.ScriptWorldId.ApplicationWorld.value)
+
+    @interactive
+    def show_page_load_timeline(self):
+        ''' Show time of recent page loads and our hooks in a sortable table.'''
+        eval_in_emacs("eaf--browser-show-page-load-timeline", [json.dumps(PageLoadTimeline.rows())])
+
+    def caret_browsing_colors(self):
+        if self.dark_mode_var == "follow":
+            return (self.theme_foreground_color, self.theme_background_color)
+        elif self.dark_mode_is_enabled():
+            return ("#FFF", "#000")
+        else:
+            return ("#000", "#FFF")
+
+    def install_caret_browsing_js(self):
+        ''' Register caret browsing js in page, so later documents get it at DOMContentLoaded.
+
+        Script runs in main world, caret commands of BrowserBuffer call it by eval_js.
+        '''
+        colors = self.caret_browsing_colors()
+        if colors == self.caret_browsing_colors_installed:
+            return
+
+        self.caret_browsing_js = JsAssetCache.format("caret_browsing.js", self.buffer_widget.read_js_content, *colors)
+
+        script = QWebEngineScript()
+        script.setName(JsAssetCache.script_name_prefix + "caret_browsing.js")
+        script.setSourceCode(self.caret_browsing_js)
+        script.setInjectionPoint(QWebEngineScript.InjectionPoint.DocumentReady)
+        script.setWorldId(QWebEngineScript.ScriptWorldId.MainWorld)
+        script.setRunsOnSubFrames(False)
+
+        page_scripts = self.buffer_widget.web_page.scripts()
+        for old_script in page_scripts.find(script.name()):
+            page_scripts.remove(old_script)
+        page_scripts.insert(script)
+
+        # Current document was created before script is registered.
+        self.buffer_widget.eval_js(self.caret_browsing_js)
+        self.caret_browsing_colors_installed = colors
 
     def after_page_load_hook(self):
         ''' Hook to run after update_progress hits 100. '''
-        self.init_pw_autofill()
+        with self.timed_hook("autofill"):
+            self.init_pw_autofill()
+
+        self.restore_closed_page_scroll()
+
+        with self.timed_hook("dark_mode"):
+            self.cache_dark_mode_css()
+
+        # Page discarded by BufferLifecycleManager is loaded again, go back to where it was.
+        if self.discarded_snapshot is not None:
+            if self.discarded_snapshot["scroll"]:
+                self.buffer_widget.eval_js("window.scrollTo(0, {});".format(int(self.discarded_snapshot["scroll"])))
+            self.discarded_snapshot = None
+
+        # Lets lazy restore of Emacs start loading next queued page.
+        if not self.first_load_finished:
+            self.first_load_finished = True
+            eval_in_emacs("eaf--browser-first-load-finished", [self.buffer_id])
 
         # Update input focus state.
         self.is_focus()
 
+    def schedule_update_position(self):
+        ''' Report first scroll at once, coalesce following scrolls until interval ends. '''
+        if self.position_timer.isActive():
+            self.position_pending = True
+        else:
+            self.update_position()
+            self.position_timer.start()
+
+    def flush_position(self):
+        # Report last position of the interval, keep coalescing if page is still scrolling.
+        if self.position_pending:
+            self.position_pending = False
+            self.update_position()
+            self.position_timer.start()
+
     def update_position(self):
         mode_line_height = get_emacs_func_cache_result("eaf-get-mode-line-height", [])
         if mode_line_height > 0.1:
@@ -306,7 +536,10 @@ class AppBuffer(BrowserBuffer):
             else:
                 pos_percentage = '0.0%'
 
-            eval_in_emacs("eaf--browser-update-position", [pos_percentage])
+            # Same percentage is already shown in mode line.
+            if pos_percentage != self.position_report:
+                self.position_report = pos_percentage
+                eval_in_emacs("eaf--browser-update-position", [pos_percentage])
 
     @PostGui()
     def handle_input_response(self, callback_tag, result_content):
@@ -314,8 +547,9 @@ class AppBuffer(BrowserBuffer):
         if not BrowserBuffer.handle_input_response(self, callback_tag, result_content):
             if callback_tag == "clear_history":
                 self._clear_history()
-            elif callback_tag == "import_chrome_history" or callback_tag == "import_safari_history":
-                self._import_history(browser_name=callback_tag.split("_")[1])
+            elif callback_tag in ["import_chrome_history", "import_safari_history", "import_firefox_history"]:
+                # Import in thread, big history db will block Emacs and the browser otherwise.
+                threading.Thread(target=self._import_history, kwargs={"browser_name": callback_tag.split("_")[1]}).start()
             elif callback_tag == "delete_all_cookies":
                 self._delete_all_cookies()
             elif callback_tag == "delete_cookie":
@@ -353,30 +587,42 @@ class AppBuffer(BrowserBuffer):
         ''' Record closing pages.'''
         self.page_closed = True
         if self.remember_history and self.arguments != "temp_html_file" and url != "about:blank":
-            touch(self.history_close_file_path)
-            with open(self.history_close_file_path, "r") as f:
-                close_urls = f.readlines()
-                close_urls.append("{0}\n".format(url))
-                open(self.history_close_file_path, "w").writelines(close_urls)
+            ClosedPageStack.get(self.history_close_file_path).push(
+                url, self.buffer_widget.title(), self.buffer_widget.web_page.scrollPosition().y())
 
     @interactive(insert_or_do=True)
     def recover_prev_close_page(self):
         ''' Recover previous closed pages.'''
-        if os.path.exists(self.history_close_file_path):
-            with open(self.history_close_file_path, "r") as f:
-                close_urls = f.readlines()
-                if len(close_urls) > 0:
-                    # We need use rstrip remove \n char from url record.
-                    prev_close_url = close_urls.pop().rstrip()
-                    open_url_in_new_tab(prev_close_url)
-                    open(self.history_close_file_path, "w").writelines(close_urls)
-
-                    message_to_emacs("Recovery {0}".format(prev_close_url))
-                else:
-                    message_to_emacs("No page need recovery.")
+        closed_page = ClosedPageStack.get(self.history_close_file_path).pop() if self.remember_history else None
+        if closed_page is not None:
+            open_url_in_new_tab(closed_page["url"])
+            message_to_emacs("Recovery {0}".format(closed_page["url"]))
         else:
             message_to_emacs("No page need recovery.")
 
+    def update_visible_buffers(self, buffer_ids):
+        ''' Called by Emacs when browser buffers shown in windows change. '''
+        BufferLifecycleManager.get().update_visible(buffer_ids or [])
+
+    @interactive
+    def show_buffer_lifecycle_stats(self):
+        ''' Show lifecycle state, idle time, cpu and memory of browser buffers.'''
+        eval_in_emacs("eaf--browser-show-report", ["*eaf-browser-lifecycle*", BufferLifecycleManager.get().report()])
+
+    def scroll_to_position_percentage(self, percentage):
+        ''' Scroll to position shown in mode line, called by Emacs after restoring page. '''
+        view_height = self.buffer_widget.height()
+        page_height = self.buffer_widget.web_page.contentsSize().height()
+        position = max(0, float(percentage) / 100 * page_height - view_height)
+        self.buffer_widget.eval_js("window.scrollTo(0, {});".format(int(position)))
+
+    def restore_closed_page_scroll(self):
+        # Page opened by recover_prev_close_page goes back to where it was closed.
+        if ClosedPageStack.instance is not None:
+            scroll = ClosedPageStack.instance.take_pending_scroll(self.url)
+            if scroll:
+                self.buffer_widget.eval_js("window.scrollTo(0, {});".format(int(scroll)))
+
     @interactive
     def toggle_dark_mode_light_theme(self):
         if self.dark_mode_theme == "dark":
@@ -392,24 +638,22 @@ class AppBuffer(BrowserBuffer):
         self.url = self.buffer_widget.url().toString()
 
     def add_password_entry(self):
-        if self.pw_autofill_raw is None:
-            self.pw_autofill_raw = self.buffer_widget.read_js_content("pw_autofill.js")
-
-        self.buffer_widget.eval_js(self.pw_autofill_raw.replace("%1", "''"))
-        password, form_data = self.buffer_widget.execute_js("retrievePasswordFromPage();")
-        if password != "":
-            from urllib.parse import urlparse
-            self.autofill.add_entry(urlparse(self.current_url).hostname, password, form_data)
-            message_to_emacs("Successfully recorded this page's password!")
-            return True
-        else:
-            message_to_emacs("There is no password present in this page!")
-            return False
+        from urllib.parse import urlparse
+        host = urlparse(self.current_url).hostname
 
-    def pw_autofill_gen_id(self, id):
-        if self.pw_autofill_raw is None:
-            self.pw_autofill_raw = self.buffer_widget.read_js_content("pw_autofill.js")
+        def record_password(result):
+            (password, form_data) = result if result else ("", None)
+            if password != "":
+                self.autofill.add_entry(host, password, form_data)
+                message_to_emacs("Successfully recorded this page's password!")
+            else:
+                message_to_emacs("There is no password present in this page!")
+
+        self.buffer_widget.eval_js(JsAssetCache.format("pw_autofill.js", self.buffer_widget.read_js_content, "''"))
+        return self.run_js_async("retrievePasswordFromPage();", record_password,
+                                 timeout_message="Page doesn't respond, failed to record password.")
 
+    def pw_autofill_gen_id(self, id):
         from urllib.parse import urlparse
         result = self.autofill.get_entries(urlparse(self.url).hostname, id)
         new_id = 0
@@ -417,7 +661,7 @@ class AppBuffer(BrowserBuffer):
             new_id = row[0]
             password = row[2]
             form_data = row[3]
-            self.buffer_widget.eval_js(self.pw_autofill_raw.replace("%1", form_data))
+            self.buffer_widget.eval_js(JsAssetCache.format("pw_autofill.js", self.buffer_widget.read_js_content, form_data))
             self.buffer_widget.eval_js('autofillPassword("%s");' % password)
             break
         return new_id
@@ -451,51 +695,10 @@ class AppBuffer(BrowserBuffer):
             else:
                 message_to_emacs("Successfully changed password autofill id!")
 
-    def is_good_history(self, history, new_url, ignore_history_list):
-        for ignore_history in ignore_history_list:
-            match = re.search(ignore_history, history.url, re.IGNORECASE)
-            if match:
-                return False
-        return history.url == new_url or history.hit > 1
-
     def _record_history(self, new_title, new_url):
         # Throw traceback info if algorithm has bug and protection of historical record is not erased.
         try:
-            noprefix_new_url_match = re.match(self.noprefix_url_pattern, new_url)
-            ignore_history_list = get_emacs_var("eaf-browser-ignore-history-list")
-            if noprefix_new_url_match is not None:
-                found_url = False
-                found_parent = False
-                for history in self.history_list:
-                    noprefix_url_match = re.match(self.noprefix_url_pattern, history.url)
-                    if noprefix_url_match is not None:
-                        noprefix_url = noprefix_url_match.group(2)
-                        noprefix_new_url = noprefix_new_url_match.group(2)
-                        nopostfix_new_url_match = re.match(self.nopostfix_url_pattern, noprefix_new_url)
-
-                        if nopostfix_new_url_match is not None and noprefix_url == nopostfix_new_url_match.group():
-                            # increment parent url
-                            history.hit += 0.25
-                            found_parent = True
-                            if found_url:
-                                break
-                        if noprefix_url == noprefix_new_url: # found_url unique url
-                            history.title = new_title
-                            history.url = new_url
-                            history.hit += 0.5
-                            found_url = True
-                            if found_parent:
-                                break
-
-                if not found_url:
-                    self.history_list.append(HistoryPage(new_title, new_url, 1))
-
-            self.history_list.sort(key = lambda x: x.hit, reverse = True)
-
-            self.history_list = [history for history in self.history_list if self.is_good_history(history, new_url, ignore_history_list)]
-
-            with open(self.history_log_file_path, "w", encoding="utf-8") as f:
-                f.writelines(map(lambda history: history.title + "ᛝ" + history.url + "ᛡ" + str(history.hit) + "\n", self.history_list))
+            self.history_store.record(new_title, new_url)
         except Exception:
             import traceback
             message_to_emacs("Error in record_history: " + str(traceback.print_exc()))
@@ -515,19 +718,37 @@ class AppBuffer(BrowserBuffer):
     @interactive(insert_or_do=True)
     def open_url_or_search_string(self, url):
         ''' Edit a URL or search a string.'''
-        is_valid_url = get_emacs_func_result('eaf-is-valid-web-url', [url])
-        if is_valid_url:
-            wrap_url = get_emacs_func_result('eaf-wrap-url', [url])
-            self.buffer_widget.setUrl(QUrl(wrap_url))
-            self.load_tampermonkey(wrap_url)
+        with self.timed_hook("userscripts"):
+            self.load_tampermonkey()
+
+        if is_valid_web_url(url):
+            self.buffer_widget.setUrl(QUrl(wrap_url(url)))
         else:
-            search_url = get_emacs_func_result('eaf--create-search-url', [url])
-            self.buffer_widget.setUrl(QUrl(search_url))
-            self.load_tampermonkey(search_url)
+            search_url = create_search_url(url)
+            if search_url is not None:
+                self.buffer_widget.setUrl(QUrl(search_url))
+
+    def search_history(self, query, limit=100):
+        ''' Return json list of history candidates of query for eaf-open-browser-with-history. '''
+        if self.history_store is None:
+            return json.dumps([])
+        return json.dumps(["[{}] ⇰ {}".format(page.title, page.url) for page in self.history_store.search(query, int(limit))])
+
+    def update_browser_config(self, name, json_value):
+        ''' Called by Emacs when a variable of eaf-browser--config-variables is changed. '''
+        value = BrowserConfig.update(name, json_value)
+        if name == "eaf-browser-ignore-history-list" and self.history_store is not None:
+            self.history_store.set_ignore_history_list(value or [])
+        elif name == "eaf-browser-adblock-collect-stats" and AdBlockManager.instance is not None:
+            AdBlockManager.instance.collect_stats = bool(value)
+        elif name == "eaf-browser-dark-mode":
+            for buffer in list(BufferLifecycleManager.get().buffers.values()):
+                buffer.dark_mode_var = value
+                buffer.install_dark_mode(buffer.buffer_widget.url(), live=True)
 
     def _clear_history(self):
         if os.path.exists(self.history_log_file_path):
-            os.remove(self.history_log_file_path)
+            self.history_store.clear()
             message_to_emacs("Cleared browsing history.")
         else:
             message_to_emacs("There is no browsing history.")
@@ -538,82 +759,23 @@ class AppBuffer(BrowserBuffer):
         self.send_input_message("Are you sure you want to clear all browsing history?", "clear_history", "yes-or-no")
 
     def _import_history(self, browser_name=None):
-        import sqlite3
-
-        if browser_name not in ["chrome", "safari"]:
+        if browser_name not in ["chrome", "safari", "firefox"]:
             message_to_emacs("Failed to get browser_name")
             return
 
-        if browser_name == "safari":
-            dbpath = os.path.expanduser(self.safari_history_file)
-        else:
-            dbpath = os.path.expanduser(self.chrome_history_file)
+        dbpath = os.path.expanduser({"chrome": self.chrome_history_file,
+                                     "safari": self.safari_history_file,
+                                     "firefox": self.firefox_history_file}[browser_name])
 
         if not os.path.exists(dbpath):
-            message_to_emacs("The chrome history file: '{}' not exist, please check your setting.".format(dbpath))
+            message_to_emacs("The {} history file: '{}' not exist, please check your setting.".format(browser_name, dbpath))
             return
 
-        message_to_emacs("Importing from {}...".format(dbpath))
-
-        conn = sqlite3.connect(dbpath)
-        # Keep lastest entry in dict by last_visit_time asc order.
-        if browser_name == "safari":
-            cursor = conn.cursor()
-            history_items = cursor.execute('SELECT id, url FROM history_items').fetchall()
-            history_visits = cursor.execute('SELECT history_item, visit_time, title FROM history_visits order by visit_time asc').fetchall()
-
-            max_visit_time = 0
-            max_visit_save_file = os.path.join(os.path.dirname(self.config_dir), "browser", "safari_history_last_update_time.txt")
-            if os.path.exists(max_visit_save_file):
-                with open(max_visit_save_file, "r", encoding="utf-8") as f:
-                    try:
-                        max_visit_time = float(f.read())
-                    except ValueError as e:
-                        message_to_emacs("Failed to read safari_history_last_update_time.txt, error: " + str(e))
-                        max_visit_time = 0
-
-            _histories = {}
-            histories = {}
-            for id, url in history_items:
-                _histories[id] = [url, '']
-
-            for history_item, visit_time, title  in history_visits:
-                if visit_time < max_visit_time:
-                    continue
-
-                if history_item not in _histories:
-                    message_to_emacs("Parse safari history file error.")
-                    return
-
-                _histories[history_item][-1] = (title)
-
-            max_visit_time = history_visits[-1][1]
-            with open(max_visit_save_file, "w") as f:
-                f.write(str(max_visit_time))
-
-            for id, url in history_items:
-                url, title = _histories[id]
-                if title is not None and len(title) > 0:
-                    histories[title] = url
-        else:
-            sql = 'select title, url from urls order by last_visit_time asc'
-            # May fetch many by many not fetch all,
-            # but this should called only once, so not important now.
-            try:
-                histories = conn.execute(sql).fetchall()
-            except sqlite3.OperationalError as e:
-                if e.args[0] == 'database is locked':
-                    message_to_emacs("The chrome history file is locked, please close your chrome app first.")
-                else:
-                    message_to_emacs("Failed to read chrome history entries: {}.".format(e))
-                return
+        if self.history_store is None:
+            message_to_emacs("Browser history is disabled, please set `eaf-browser-remember-history' first.")
+            return
 
-        histories = dict(histories)  # Drop duplications with same title.
-        total = len(histories)
-        for i, (title, url) in enumerate(histories.items(), 1):
-            self._record_history(title, url)
-            message_to_emacs("Importing {} / {} ...".format(i, total))
-        message_to_emacs("{} {} history entries imported.".format(total, browser_name))
+        HistoryImporter(self.history_store, self.config_dir).import_history(browser_name, dbpath)
 
     @interactive
     def import_safari_history(self):
@@ -625,6 +787,11 @@ class AppBuffer(BrowserBuffer):
         ''' Import history entries from chrome history db.'''
         self.send_input_message("Are you sure you want to import all history from chrome?", "import_chrome_history", "yes-or-no")
 
+    @interactive
+    def import_firefox_history(self):
+        ''' Import history entries from firefox places db.'''
+        self.send_input_message("Are you sure you want to import all history from firefox?", "import_firefox_history", "yes-or-no")
+
     def _delete_all_cookies(self):
         ''' Delete all cookies.'''
         self.buffer_widget.delete_all_cookies()
@@ -645,56 +812,170 @@ class AppBuffer(BrowserBuffer):
         ''' Delete cookie of current site.'''
         self.send_input_message("Are you sure you want to delete cookie of current site?", "delete_cookie", "yes-or-no")
 
-    def load_readability_js(self):
-        if self.readability_js is None:
-            self.readability_js = open(os.path.join(os.path.dirname(__file__),
-                                                    "node_modules",
-                                                    "@mozilla",
-                                                    "readability",
-                                                    "Readability.js"
-                                                    ), encoding="utf-8").read()
+    def run_js_async(self, js, callback, world_id=QWebEngineScript.ScriptWorldId.MainWorld.value, timeout_message=None):
+        ''' Run js without waiting for renderer, callback is called with result in GUI thread.
+
+        If renderer doesn't answer in JS_TIMEOUT milliseconds, timeout_message is
+        sent to Emacs and late result is dropped. Return JsRequest, its cancel()
+        drops result too, requests are cancelled when page navigates away.
+        '''
+        request = JsRequest(callback, (lambda: message_to_emacs(timeout_message)) if timeout_message else None)
+        self.js_requests.add(request)
+        request.finished = lambda: self.js_requests.discard(request)
+
+        self.buffer_widget.web_page.runJavaScript(js, world_id, request.resolve)
+        QTimer.singleShot(self.JS_TIMEOUT, request.expire)
+        return request
+
+    def cancel_js_requests(self):
+        for request in list(self.js_requests):
+            request.cancel()
+
+    def extract_article(self, callback):
+        ''' Parse page by Readability in application world and call callback with article, None if page can't be parsed.
 
-        self.buffer_widget.eval_js(self.readability_js)
+        Readability parses a clone of document, so page is neither blocked nor changed,
+        article is cached by url and content hash for other reader commands.
+        '''
+        url = self.url
+
+        timeout_message = "Page doesn't respond, failed to parse text content."
+
+        def extract(info):
+            if info is None:
+                callback(None)
+                return
+
+            key = (url, info["contentHash"])
+            article = ReaderArticleCache.articles.get(key)
+            if article is not None:
+                callback(article)
+                return
+
+            if not info["hasReadability"]:
+                # Scripts of one world run in order, Readability is defined before parse below.
+                self.buffer_widget.web_page.runJavaScript(
+                    JsAssetCache.content("Readability.js", JsAssetCache.read_readability_js),
+                    ReaderArticleCache.world_id)
+
+            def parsed(article):
+                if article is not None:
+                    ReaderArticleCache.articles.put(key, article)
+                callback(article)
+
+            self.run_js_async(ReaderArticleCache.parse_js, parsed, ReaderArticleCache.world_id, timeout_message)
+
+        return self.run_js_async(ReaderArticleCache.info_js, extract, ReaderArticleCache.world_id, timeout_message)
 
     @interactive(insert_or_do=True)
     def switch_to_reader_mode(self):
-        if self.buffer_widget.execute_js("document.getElementById('readability-page-1') != null;"):
-            message_to_emacs("Reader mode has been enable in current page.")
-        else:
-            self.load_readability_js()
-
-            html = self.buffer_widget.execute_js("new Readability(document).parse().content;")
-            if html is None:
-                self.refresh_page()
+        def show_article(article):
+            if article is None:
                 message_to_emacs("Cannot parse text content of current page, failed to switch reader mode.")
             else:
-                self.buffer_widget.setHtml(get_emacs_var("eaf-browser-reader-mode-style") + html)
+                self.buffer_widget.setHtml(BrowserConfig.get("eaf-browser-reader-mode-style") + article["content"])
+
+        def switch(reader_mode):
+            if reader_mode:
+                message_to_emacs("Reader mode has been enable in current page.")
+            else:
+                self.extract_article(show_article)
+
+        self.run_js_async("document.getElementById('readability-page-1') != null;", switch, ReaderArticleCache.world_id,
+                          "Page doesn't respond, failed to switch reader mode.")
 
     @interactive(insert_or_do=True)
     def export_text(self):
-        self.load_readability_js()
+        url = self.url
 
-        text = self.buffer_widget.execute_js("new Readability(document).parse().textContent;")
-        self.refresh_page()
-        eval_in_emacs('eaf--browser-export-text', ["EAF-BROWSER-TEXT-" + self.url, text])
+        def export(article):
+            if article is None:
+                message_to_emacs("Cannot parse text content of current page, failed to export text.")
+            else:
+                eval_in_emacs('eaf--browser-export-text', ["EAF-BROWSER-TEXT-" + url, article["textContent"]])
+
+        self.extract_article(export)
 
     @interactive(insert_or_do=True)
     def render_by_eww(self):
-        self.load_readability_js()
+        url = self.url
+
+        def render(article):
+            if article is None:
+                message_to_emacs("Cannot parse text content of current page, failed to render by eww.")
+            else:
+                import tempfile
 
-        html = self.buffer_widget.execute_js("new Readability(document).parse().content;")
-        if html is None:
-            self.refresh_page()
-            message_to_emacs("Cannot parse text content of current page, failed to render by eww.")
+                new_file, filename = tempfile.mkstemp(suffix=".html")
+                with os.fdopen(new_file, 'w') as tmp:
+                    tmp.write(BrowserConfig.get("eaf-browser-reader-mode-style") + article["content"])
+
+                eval_in_emacs("eaf--browser-render-by-eww", [url, filename])
+
+        self.extract_article(render)
+
+    @interactive
+    def update_adblock_filter_lists(self):
+        ''' Reload adblock filter lists and rebuild adblock engine in background.'''
+        if (found_adblock or found_braveblock) and self.enable_adblocker:
+            # Lists may be customized after manager was created, pick them up before rebuilding.
+            self.adblock_filter_lists = get_emacs_var("eaf-browser-adblock-filter-lists")
+            manager = AdBlockManager.get(os.path.join(self.config_dir, "browser", "adblock"), self.adblock_filter_lists)
+            manager.filter_list_specs = self.adblock_filter_lists
+            manager.rebuild()
+            message_to_emacs("Updating adblock filter lists...")
         else:
-            import tempfile
+            message_to_emacs("Adblocker is not enabled.")
+
+    def update_cosmetic_filter_on_loading(self, loading_info):
+        if loading_info.status() == loading_info.LoadStatus.LoadStartedStatus:
+            with self.timed_hook("cosmetic"):
+                self.update_cosmetic_filter(loading_info.url())
 
-            new_file, filename = tempfile.mkstemp(suffix=".html")
-            with os.fdopen(new_file, 'w') as tmp:
-                tmp.write(get_emacs_var("eaf-browser-reader-mode-style") + html)
+    def update_cosmetic_filter(self, url):
+        ''' Register element hiding stylesheet of url's host in page. '''
+        if not self.enable_adblocker:
+            return
+
+        manager = self.interceptor.manager
+        engine = manager.engine
+        if engine is None:
+            return
+        manager.install_cosmetic_filter(self.profile)
+
+        # Same encoding as location.hostname.
+        host = url.host(QUrl.ComponentFormattingOption.FullyEncoded)
+        if self.cosmetic_filter_key == (host, engine):
+            return
+        self.cosmetic_filter_key = (host, engine)
 
-            self.refresh_page()
-            eval_in_emacs("eaf--browser-render-by-eww", [self.url, filename])
+        page_scripts = self.buffer_widget.web_page.scripts()
+        for script in page_scripts.find(AdBlockCosmeticFilter.host_script_name):
+            page_scripts.remove(script)
+
+        script = engine.cosmetic_filter.host_script(host)
+        if script is not None:
+            page_scripts.insert(script)
+
+    @interactive
+    def show_adblock_stats(self):
+        ''' Show filter lists cost, request latency, per host counts and slowest requests of adblocker.'''
+        if AdBlockManager.instance is None:
+            message_to_emacs("Adblocker is not enabled.")
+        else:
+            eval_in_emacs("eaf--browser-show-report", ["*eaf-browser-adblock*", AdBlockManager.instance.report()])
+
+    @interactive
+    def save_adblock_corpus(self):
+        ''' Save recent adblock requests as corpus of adblock_benchmark.py.'''
+        if AdBlockManager.instance is None:
+            message_to_emacs("Adblocker is not enabled.")
+        elif not AdBlockManager.instance.collect_stats:
+            message_to_emacs("Please set `eaf-browser-adblock-collect-stats' to record requests first.")
+        else:
+            corpus_path = os.path.join(self.config_dir, "browser", "adblock", "corpus.txt")
+            count = AdBlockManager.instance.stats.save_corpus(corpus_path)
+            message_to_emacs("Saved {} requests to {}".format(count, corpus_path))
 
     def page_is_loading(self):
         return self.is_loading
@@ -739,7 +1020,7 @@ class AppBuffer(BrowserBuffer):
 
     def dark_mode_is_enabled(self):
         ''' Return bool of whether dark mode is enabled.'''
-        dark_mode_var = get_emacs_var("eaf-browser-dark-mode")
+        dark_mode_var = BrowserConfig.get("eaf-browser-dark-mode")
         return (dark_mode_var == "force" or \
                 dark_mode_var is True or \
                 (dark_mode_var == "follow" and \
@@ -749,56 +1030,1903 @@ class AppBuffer(BrowserBuffer):
     def init_web_page_background(self):
         self.buffer_widget.web_page.setBackgroundColor(QColor(get_emacs_theme_background()))
 
+class BrowserConfig():
+    ''' Emacs variables read on hot paths, fetched once and then pushed by Emacs when they change.
+
+    Names are listed in eaf-browser--config-variables, values are decoded from json.
+    '''
+
+    values = None
+    lock = threading.Lock()
+
+    @classmethod
+    def get(cls, name):
+        with cls.lock:
+            if cls.values is None:
+                cls.values = json.loads(get_emacs_func_result("eaf-browser--config-json", []))
+            return cls.values.get(name)
+
+    @classmethod
+    def reset(cls):
+        ''' Drop values, they are fetched again on next get(). '''
+        with cls.lock:
+            cls.values = None
+
+    @classmethod
+    def update(cls, name, json_value):
+        value = json.loads(json_value)
+        with cls.lock:
+            if cls.values is not None:
+                cls.values[name] = value
+        return value
+
+# Same as eaf-is-valid-web-url, Emacs regexp is case insensitive and "{1,5}" is literal in it.
+web_url_re = re.compile(r'^(https?://)?[a-z0-9]+([-.][a-z0-9]+)*.+\..+[a-z0-9.]{1,6}(:[0-9]\{1,5\})?(/.*)?$', re.IGNORECASE)
+local_url_re = re.compile(r'^(https?://)?(localhost|127.0.0.1):[0-9]+/?', re.IGNORECASE)
+
+def is_valid_web_url(url):
+    ''' Port of eaf-is-valid-web-url, url entry doesn't need to ask Emacs. '''
+    return (url is not None and
+            len(url.split()) < 2 and
+            ((url.startswith("file://") and url.endswith(".html")) or
+             web_url_re.search(url) is not None or
+             local_url_re.search(url) is not None))
+
+def wrap_url(url):
+    ''' Port of eaf-wrap-url. '''
+    if url.startswith(("http://", "https://", "file://", "chrome://")):
+        return url
+    return "http://" + url
+
+def create_search_url(search_string, search_engine=None):
+    ''' Port of eaf--create-search-url, return None if search engine is unknown. '''
+    search_engine = search_engine or BrowserConfig.get("eaf-browser-default-search-engine")
+    link = (BrowserConfig.get("eaf-browser-search-engines") or {}).get(search_engine)
+    if link is None:
+        message_to_emacs("Search engine {} is unknown to EAF!".format(search_engine))
+        return None
+    return link.replace("%s", search_string)
+
+class LruCache():
+    ''' Dict keeping the max_size most recently used keys, callers do their own locking. '''
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = OrderedDict()
+
+    def get(self, key):
+        ''' Return value of key, None if it's not cached. '''
+        value = self.items.get(key)
+        if value is not None:
+            self.items.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        if len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
+
+class JsAssetCache():
+    ''' Js files injected into pages, read once and formatted once per arguments, shared by all buffers. '''
+
+    FORMAT_CACHE_SIZE = 64
+
+    script_name_prefix = "eaf-browser:"
+
+    contents = {}                # name -> raw content
+    formatted = LruCache(FORMAT_CACHE_SIZE)  # (name, arguments) -> content with %1, %2... replaced by arguments
+    lock = threading.Lock()
+
+    @classmethod
+    def content(cls, name, reader):
+        ''' Return content of js file name, call reader(name) to read it first time. '''
+        with cls.lock:
+            if name in cls.contents:
+                return cls.contents[name]
+        content = reader(name)
+        with cls.lock:
+            cls.contents[name] = content
+        return content
+
+    @classmethod
+    def format(cls, name, reader, *arguments):
+        key = (name, arguments)
+        with cls.lock:
+            content = cls.formatted.get(key)
+        if content is not None:
+            return content
+
+        content = cls.content(name, reader)
+        for (index, argument) in enumerate(arguments):
+            content = content.replace("%{}".format(index + 1), argument)
+
+        with cls.lock:
+            cls.formatted.put(key, content)
+        return content
+
+    @staticmethod
+    def read_readability_js(name):
+        with open(os.path.join(os.path.dirname(__file__), "node_modules", "@mozilla", "readability", name), encoding="utf-8") as f:
+            return f.read()
+
+class PageLoad():
+    ''' Timing of one navigation of a buffer, in seconds since navigation start. '''
+
+    def __init__(self, buffer_id, url, hooks):
+        self.buffer_id = buffer_id
+        self.url = url
+        self.start_time = time.time()
+        self.first_progress = None
+        self.dom_content_loaded = None  # from Navigation Timing of page
+        self.load_event = None
+        self.load_time = None           # progress hits 100
+        self.hooks = hooks              # hook name -> seconds spent in our hook
+        self.adblock_start = None
+        self.blocked = None
+        self.allowed = None
+
+class PageLoadTimeline():
+    ''' Recent page loads of all buffers, oldest are dropped after MAX_SIZE loads. '''
+
+    MAX_SIZE = 200
+
+    HOOKS = ["marker", "caret", "autofill", "dark_mode", "userscripts", "cosmetic"]
+
+    timing_js = '''(function() {
+    var entry = performance.getEntriesByType("navigation")[0];
+    return entry ? {domContentLoaded: entry.domContentLoadedEventEnd, load: entry.loadEventEnd} : null;
+})();'''
+
+    page_loads = deque(maxlen=MAX_SIZE)
+
+    @classmethod
+    def add(cls, page_load):
+        cls.page_loads.append(page_load)
+
+    @classmethod
+    def rows(cls):
+        ''' Return rows of report, times in milliseconds, empty string if unknown. '''
+        def milliseconds(seconds):
+            return "" if seconds is None else "{:.0f}".format(seconds * 1000)
+
+        rows = []
+        for page_load in reversed(cls.page_loads):
+            rows.append([time.strftime("%H:%M:%S", time.localtime(page_load.start_time)),
+                         milliseconds(page_load.load_time),
+                         milliseconds(page_load.first_progress),
+                         milliseconds(page_load.dom_content_loaded),
+                         milliseconds(page_load.load_event)] +
+                        [milliseconds(page_load.hooks.get(hook)) for hook in cls.HOOKS] +
+                        ["" if page_load.blocked is None else str(page_load.blocked),
+                         "" if page_load.allowed is None else str(page_load.allowed),
+                         page_load.url])
+        return rows
+
+class JsRequest():
+    ''' Pending run_js_async call, exactly one of callback, timeout and cancel takes effect. '''
+
+    def __init__(self, callback, on_timeout):
+        self.callback = callback
+        self.on_timeout = on_timeout
+        self.finished = None
+        self.done = False
+
+    def finish(self):
+        self.done = True
+        if self.finished is not None:
+            self.finished()
+
+    def resolve(self, result):
+        if not self.done:
+            self.finish()
+            self.callback(result)
+
+    def expire(self):
+        if not self.done:
+            self.finish()
+            if self.on_timeout is not None:
+                self.on_timeout()
+
+    def cancel(self):
+        if not self.done:
+            self.finish()
+
+class DarkModeCssCache():
+    ''' Css generated by Dark Reader, keyed by origin and theme, shared by all buffers. '''
+
+    CACHE_SIZE = 32
+    EXPORT_DELAY = 1000  # milliseconds
+
+    darkreader_script_name = "eaf-dark-mode:darkreader"
+    css_script_name = "eaf-dark-mode:cached-css"
+
+    styles = LruCache(CACHE_SIZE)
+
+    @staticmethod
+    def origin(url):
+        if url.scheme() not in ["http", "https"]:
+            return None
+        return url.adjusted(QUrl.UrlFormattingOption.RemovePath |
+                            QUrl.UrlFormattingOption.RemoveQuery |
+                            QUrl.UrlFormattingOption.RemoveFragment |
+                            QUrl.UrlFormattingOption.RemoveUserInfo).toString(QUrl.ComponentFormattingOption.FullyEncoded)
+
+class ReaderArticleCache():
+    ''' Readability articles of recent pages, keyed by url and content hash, shared by all buffers. '''
+
+    CACHE_SIZE = 32
+
+    world_id = QWebEngineScript.ScriptWorldId.ApplicationWorld.value
+
+    info_js = '''(function() {
+    var html = document.documentElement ? document.documentElement.outerHTML : "";
+    var hash = 0;
+    for (var i = 0; i < html.length; i++) {
+        hash = (hash * 31 + html.charCodeAt(i)) | 0;
+    }
+    return {
+        contentHash: html.length + ":" + hash,
+        hasReadability: typeof Readability !== "undefined"
+    };
+})();'''
+
+    parse_js = '''(function() {
+    var article = new Readability(document.cloneNode(true)).parse();
+    return article ? {title: article.title, content: article.content, textContent: article.textContent} : null;
+})();'''
+
+    articles = LruCache(CACHE_SIZE)
+
+def get_process_usage(pid):
+    ''' Return (cpu seconds, resident bytes) of process pid, None if unknown. '''
+    try:
+        with open("/proc/{}/stat".format(pid), "r") as f:
+            # Fields after command name, which may contain spaces.
+            fields = f.read().rpartition(")")[2].split()
+        with open("/proc/{}/statm".format(pid), "r") as f:
+            resident = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        return ((int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK"), resident)
+    except (OSError, ValueError, IndexError):
+        return None
+
+class BufferLifecycleManager():
+    ''' Freeze and then discard pages of browser buffers not shown in any Emacs window.
+
+    Emacs pushes ids of shown buffers, a hidden buffer is frozen after
+    eaf-browser-freeze-hidden-after seconds and discarded after
+    eaf-browser-discard-hidden-after seconds, both are off by default. Url, title and scroll position
+    are kept when discarding, QtWebEngine loads the page again once it's
+    active, and the scroll position is restored after load.
+    '''
+
+    CHECK_INTERVAL = 10000  # milliseconds
+
+    instance = None
+
+    @classmethod
+    def get(cls):
+        if cls.instance is None:
+            cls.instance = cls()
+        return cls.instance
+
+    def __init__(self):
+        self.buffers = weakref.WeakValueDictionary()  # buffer id -> AppBuffer
+        self.hidden_since = {}  # buffer id -> time buffer was hidden
+        self.visible_ids = set()
+        self.cpu_samples = {}   # render process pid -> (time, cpu seconds, cpu percentage)
+
+        self.timer = QTimer()
+        self.timer.setInterval(self.CHECK_INTERVAL)
+        self.timer.timeout.connect(self.check)
+        self.timer.start()
+
+    def register(self, buffer):
+        self.buffers[buffer.buffer_id] = buffer
+        # Emacs may report new buffer shown before it is registered, buffer opened in background is never reported.
+        if buffer.buffer_id not in self.visible_ids:
+            self.hidden_since[buffer.buffer_id] = time.time()
+
+    def lifecycle_states(self, page):
+        # LifecycleState is missing in old Qt.
+        return getattr(page, "LifecycleState", None)
+
+    def update_visible(self, buffer_ids):
+        self.visible_ids = set(buffer_ids)
+        now = time.time()
+        for (buffer_id, buffer) in list(self.buffers.items()):
+            if buffer_id in self.visible_ids:
+                self.hidden_since.pop(buffer_id, None)
+                self.set_state(buffer, "Active")
+            elif buffer_id not in self.hidden_since:
+                self.hidden_since[buffer_id] = now
+
+    def set_state(self, buffer, state_name):
+        try:
+            page = buffer.buffer_widget.web_page
+            states = self.lifecycle_states(page)
+            if states is None:
+                return
+            state = getattr(states, state_name)
+            if page.lifecycleState() == state:
+                return
+
+            if state_name == "Discarded":
+                buffer.discarded_snapshot = {"url": buffer.url,
+                                             "title": buffer.buffer_widget.title(),
+                                             "scroll": page.scrollPosition().y()}
+            page.setLifecycleState(state)
+            if page.lifecycleState() != state:
+                # QtWebEngine refuses some transitions, e.g. discarding a visible page.
+                buffer.discarded_snapshot = None
+        except RuntimeError:
+            # Qt object of killed buffer is deleted already.
+            self.buffers.pop(buffer.buffer_id, None)
+
+    def check(self):
+        (freeze_after, discard_after) = (BrowserConfig.get("eaf-browser-freeze-hidden-after"),
+                                         BrowserConfig.get("eaf-browser-discard-hidden-after"))
+        now = time.time()
+        for (buffer_id, hidden_since) in list(self.hidden_since.items()):
+            buffer = self.buffers.get(buffer_id)
+            if buffer is None:
+                del self.hidden_since[buffer_id]
+                continue
+
+            # Don't stop pages playing audio or loading.
+            idle_time = now - hidden_since
+            try:
+                busy = buffer.buffer_widget.web_page.recentlyAudible() or buffer.is_loading
+            except RuntimeError:
+                busy = True
+            if busy:
+                continue
+
+            if discard_after is not None and idle_time >= discard_after:
+                self.set_state(buffer, "Discarded")
+            elif freeze_after is not None and idle_time >= freeze_after:
+                self.set_state(buffer, "Frozen")
+
+        self.sample_cpu(now)
+
+    def render_process_pid(self, buffer):
+        try:
+            return buffer.buffer_widget.web_page.renderProcessPid()
+        except (AttributeError, RuntimeError):
+            return 0
+
+    def sample_cpu(self, now):
+        ''' Update cpu percentage of render processes since last sample. '''
+        samples = {}
+        for buffer in list(self.buffers.values()):
+            pid = self.render_process_pid(buffer)
+            if pid <= 0 or pid in samples:
+                continue
+            usage = get_process_usage(pid)
+            if usage is None:
+                continue
+            (last_time, last_cpu, cpu_percentage) = self.cpu_samples.get(pid, (None, None, None))
+            if last_time is not None and now > last_time:
+                cpu_percentage = (usage[0] - last_cpu) * 100 / (now - last_time)
+            samples[pid] = (now, usage[0], cpu_percentage)
+        self.cpu_samples = samples
+
+    def report(self):
+        self.sample_cpu(time.time())
+
+        lines = ["{:<8} {:<10} {:>8} {:>8} {:>7} {:>9}  {}".format(
+            "Buffer", "State", "Hidden", "Pid", "CPU", "Memory", "Url")]
+        now = time.time()
+        for (buffer_id, buffer) in sorted(self.buffers.items()):
+            try:
+                page = buffer.buffer_widget.web_page
+                states = self.lifecycle_states(page)
+                state = page.lifecycleState().name if states is not None else "Active"
+                url = buffer.url
+            except RuntimeError:
+                continue
+
+            pid = self.render_process_pid(buffer)
+            usage = get_process_usage(pid) if pid > 0 else None
+            cpu_percentage = self.cpu_samples.get(pid, (None, None, None))[2]
+            hidden_since = self.hidden_since.get(buffer_id)
+            lines.append("{:<8} {:<10} {:>8} {:>8} {:>7} {:>9}  {}".format(
+                buffer_id[:8],
+                state,
+                "-" if hidden_since is None else "{:.0f}s".format(now - hidden_since),
+                pid or "-",
+                "-" if cpu_percentage is None else "{:.1f}%".format(cpu_percentage),
+                "-" if usage is None else "{:.1f}MB".format(usage[1] / 1024 / 1024),
+                url))
+        lines.append("")
+        lines.append("Pages of one site may share a render process, cpu and memory are per process.")
+        return "\n".join(lines)
+
+class ClosedPageStack():
+    ''' Recently closed pages, newest last, shared by all browser buffers.
+
+    Every close or recovery appends one json line to close.txt, the file is
+    rewritten from memory once it has COMPACT_THRESHOLD more lines than the
+    stack. Lines of old close.txt only have url, they are still loaded.
+    '''
+
+    MAX_SIZE = 100
+    COMPACT_THRESHOLD = 200
+
+    instance = None
+    instance_lock = threading.Lock()
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.pages = deque(maxlen=self.MAX_SIZE)  # {"url", "title", "scroll", "time"}
+        self.pending_scrolls = {}                   # url -> scroll position of recovering page
+        self.lock = threading.Lock()
+        self.file = None
+        self.file_lines = 0
+
+        if os.path.exists(file_path):
+            with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
+                for line in f:
+                    self.replay(line.rstrip("\n"))
+                    self.file_lines += 1
+        if self.file_lines > len(self.pages) + self.COMPACT_THRESHOLD:
+            self.compact()
+
+    @classmethod
+    def get(cls, file_path):
+        with cls.instance_lock:
+            if cls.instance is None:
+                cls.instance = cls(file_path)
+            return cls.instance
+
+    def replay(self, line):
+        if line.startswith("{"):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                return
+            if record.get("pop"):
+                if len(self.pages) > 0:
+                    self.pages.pop()
+            elif "url" in record:
+                self.pages.append(record)
+        elif line != "":
+            self.pages.append({"url": line, "title": "", "scroll": 0, "time": 0})
+
+    def append(self, record):
+        if self.file is None:
+            os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+            self.file = open(self.file_path, "a", encoding="utf-8")
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+        self.file_lines += 1
+
+        if self.file_lines > len(self.pages) + self.COMPACT_THRESHOLD:
+            self.compact()
+
+    def compact(self):
+        ''' Rewrite file with pages in memory, file is replaced by atomic rename. '''
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+        os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+        tmp_file_path = self.file_path + ".tmp"
+        with open(tmp_file_path, "w", encoding="utf-8") as f:
+            f.writelines(map(lambda page: json.dumps(page, ensure_ascii=False) + "\n", self.pages))
+        os.replace(tmp_file_path, self.file_path)
+        self.file_lines = len(self.pages)
+
+    def push(self, url, title, scroll):
+        with self.lock:
+            page = {"url": url, "title": title, "scroll": scroll, "time": int(time.time())}
+            self.pages.append(page)
+            self.append(page)
+
+    def pop(self):
+        ''' Remove and return newest closed page, None if there is none. '''
+        with self.lock:
+            if len(self.pages) == 0:
+                return None
+            page = self.pages.pop()
+            self.append({"pop": True})
+            if page.get("scroll"):
+                self.pending_scrolls[page["url"]] = page["scroll"]
+            return page
+
+    def take_pending_scroll(self, url):
+        with self.lock:
+            return self.pending_scrolls.pop(url, None)
+
 class HistoryPage():
-    def __init__(self, title, url, hit):
+    def __init__(self, title, url, hit, visit_time=0):
         self.title = title
         self.url = url
         self.hit = float(hit)
+        self.visit_time = visit_time
+
+class HistorySearchIndex():
+    ''' Trigram index over the lowercase title and url of history pages.
+
+    Posting lists hold document ids, a page gets a new document when its
+    title or url change and the old one is left as a tombstone until the
+    index is rebuilt.
+    '''
+
+    def __init__(self):
+        self.postings = {}  # trigram -> array of doc ids
+        self.doc_keys = []  # doc id -> url key, None once the page is gone
+        self.doc_ids = {}   # url key -> doc id
+
+    @staticmethod
+    def haystack(page):
+        return page.title.lower() + " " + page.url.lower()
+
+    @staticmethod
+    def trigrams(text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def add(self, key, page):
+        self.remove(key)
+
+        doc_id = len(self.doc_keys)
+        self.doc_keys.append(key)
+        self.doc_ids[key] = doc_id
+        for trigram in self.trigrams(self.haystack(page)):
+            posting = self.postings.get(trigram)
+            if posting is None:
+                posting = self.postings[trigram] = array.array("I")
+            posting.append(doc_id)
+
+    def remove(self, key):
+        doc_id = self.doc_ids.pop(key, None)
+        if doc_id is not None:
+            self.doc_keys[doc_id] = None
+
+    def need_rebuild(self):
+        return len(self.doc_keys) > 2 * len(self.doc_ids) + 1000
+
+    def candidates(self, tokens):
+        ''' Return keys that may contain all tokens, None if no token is long enough to use the index. '''
+        posting = None
+        for token in tokens:
+            for trigram in self.trigrams(token):
+                token_posting = self.postings.get(trigram)
+                if token_posting is None:
+                    return []
+                if posting is None or len(token_posting) < len(posting):
+                    posting = token_posting
+
+        if posting is None:
+            return None
+        return [self.doc_keys[doc_id] for doc_id in posting if self.doc_keys[doc_id] is not None]
+
+class UrlRegexpMatcher():
+    ''' Case insensitive search of a list of regexps, merged into one alternation. '''
+    def __init__(self, regexps):
+        self.regexps = list(regexps)
+
+        valid_regexps = []
+        for regexp in self.regexps:
+            try:
+                re.compile(regexp)
+                valid_regexps.append(regexp)
+            except re.error as e:
+                message_to_emacs("Invalid regexp '{}': {}".format(regexp, e))
+
+        try:
+            self.patterns = [re.compile("|".join(map(lambda regexp: "(?:" + regexp + ")", valid_regexps)), re.IGNORECASE)] \
+                if len(valid_regexps) > 0 else []
+        except re.error:
+            # Regexps with inline flags or duplicate group names can't be merged.
+            self.patterns = [re.compile(regexp, re.IGNORECASE) for regexp in valid_regexps]
+
+    def search(self, url):
+        for pattern in self.patterns:
+            if pattern.search(url):
+                return True
+        return False
+
+class HistoryStore():
+    ''' Browser history indexed by url, ordered by hit score.
+
+    Pages are looked up through the url without its scheme, so http/https
+    variants of one page share a single entry, and the parent of a url is
+    simply the entry whose key has no query or fragment.
+
+    log.txt is the snapshot, every visit only appends the pages it changed to
+    log.journal, and a background thread folds the journal back into the
+    snapshot once it grows past COMPACT_THRESHOLD records.
+
+    One store is shared by every browser buffer, use HistoryStore.get().
+    '''
+
+    COMPACT_THRESHOLD = 1000
+
+    instance = None
+    instance_lock = threading.Lock()
+
+    history_pattern = re.compile(r"^(.+)ᛝ(.+)ᛡ(.+)$")
+    journal_pattern = re.compile(r"^(.*)ᛝ(.+)ᛡ(.+)$")
+    old_history_pattern = re.compile(r"(.*)\s((https?|file):[^\s]+)$")
+    noprefix_url_pattern = re.compile(r"^(https?|file)://(.+)")
+    nopostfix_url_pattern = re.compile(r"^[^#\?]*")
+
+    def __init__(self, log_file_path):
+        self.log_file_path = log_file_path
+        self.journal_file_path = os.path.splitext(log_file_path)[0] + ".journal"
+        # Journal being folded into the snapshot, replayed at startup if compaction was interrupted.
+        self.compacting_file_path = self.journal_file_path + ".compacting"
+
+        self.pages = {}         # url key -> HistoryPage
+        self.ranking = []       # sorted (-hit, url key), highest hit first
+        self.weak_keys = set()  # keys of pages visited once in this session, dropped on the next visit elsewhere
+
+        self.changed_keys = set()
+        self.removed_urls = []
+
+        self.lock = threading.RLock()
+        # Serializes snapshot writers, always taken before self.lock.
+        self.write_lock = threading.Lock()
+        self.loaded = threading.Event()
+        self.pending_lock = threading.Lock()
+        self.pending_visits = []  # visits recorded before load finished
+        self.ignore_matcher = None
+
+        self.search_index = None
+        self.search_generation = 0  # increased when pages are added, removed or renamed
+        self.last_search = None     # (query, generation, matched keys) of the previous search
+        self.journal_file = None
+        self.journal_records = 0
+        self.compact_thread = None
+
+    @classmethod
+    def get(cls, log_file_path):
+        ''' Return the process-wide store, start loading it on first call. '''
+        with cls.instance_lock:
+            if cls.instance is None:
+                cls.instance = cls(log_file_path)
+                threading.Thread(target=cls.instance.load).start()
+            return cls.instance
+
+    def url_key(self, url):
+        match = self.noprefix_url_pattern.match(url)
+        if match is None:
+            return None
+        return match.group(2)
+
+    def parent_key(self, key):
+        return self.nopostfix_url_pattern.match(key).group()
+
+    def load(self):
+        with self.lock:
+            touch(self.log_file_path)
+            with open(self.log_file_path, "r", encoding="utf-8") as f:
+                for raw_his in f:
+                    his_line = self.history_pattern.match(raw_his)
+                    if his_line is None: # Obsolete Old history format
+                        old_his = self.old_history_pattern.match(raw_his)
+                        if old_his is not None:
+                            self.add(HistoryPage(old_his.group(1), old_his.group(2), 1))
+                    else:
+                        self.add(HistoryPage(his_line.group(1), his_line.group(2), his_line.group(3)))
+
+            for journal_path in [self.compacting_file_path, self.journal_file_path]:
+                if os.path.exists(journal_path):
+                    self.journal_records += self.replay(journal_path)
+
+            self.changed_keys.clear()
+            self.removed_urls.clear()
+
+            self.build_search_index()
+
+            with self.pending_lock:
+                for (new_title, new_url) in self.pending_visits:
+                    self._record(new_title, new_url)
+                self.write_journal()
+                self.pending_visits = []
+                self.loaded.set()
+
+        self.maybe_compact()
+
+    def replay(self, journal_path):
+        records = 0
+        with open(journal_path, "r", encoding="utf-8") as f:
+            for raw_record in f:
+                record = self.journal_pattern.match(raw_record)
+                # Skip the torn last line a crash can leave behind.
+                if record is None or not raw_record.endswith("\n"):
+                    continue
+
+                (title, url, hit) = record.groups()
+                key = self.url_key(url) or url
+                if hit == "-":
+                    self.remove(key)
+                else:
+                    try:
+                        hit = float(hit)
+                    except ValueError:
+                        continue
+
+                    if key in self.pages:
+                        page = self.pages[key]
+                        self.rename(key, title, url)
+                        self.bump(key, hit - page.hit)
+                    else:
+                        self.add(HistoryPage(title, url, hit))
+                records += 1
+        return records
+
+    def add(self, page):
+        ''' Add page, first entry wins if the url is already present. '''
+        key = self.url_key(page.url) or page.url
+        if key in self.pages:
+            return
+
+        self.pages[key] = page
+        bisect.insort(self.ranking, (-page.hit, key))
+        self.changed_keys.add(key)
+
+        if self.search_index is not None:
+            self.search_index.add(key, page)
+        self.search_generation += 1
+
+    def remove(self, key):
+        page = self.pages.pop(key, None)
+        if page is not None:
+            self._unrank(key, page.hit)
+            self.weak_keys.discard(key)
+            self.changed_keys.discard(key)
+            self.removed_urls.append(page.url)
+
+            if self.search_index is not None:
+                self.search_index.remove(key)
+            self.search_generation += 1
+
+    def rename(self, key, title, url):
+        page = self.pages[key]
+        if page.title != title or page.url != url:
+            page.title = title
+            page.url = url
+
+            if self.search_index is not None:
+                self.search_index.add(key, page)
+            self.search_generation += 1
+
+    def _unrank(self, key, hit):
+        index = bisect.bisect_left(self.ranking, (-hit, key))
+        del self.ranking[index]
+
+    def bump(self, key, increment):
+        page = self.pages[key]
+        self._unrank(key, page.hit)
+        page.hit += increment
+        bisect.insort(self.ranking, (-page.hit, key))
+        self.changed_keys.add(key)
+
+    def set_ignore_history_list(self, ignore_history_list):
+        ''' Compile eaf-browser-ignore-history-list, only rebuilt when the list changed. '''
+        ignore_history_list = list(ignore_history_list or [])
+        if self.ignore_matcher is None or self.ignore_matcher.regexps != ignore_history_list:
+            self.ignore_matcher = UrlRegexpMatcher(ignore_history_list)
+
+    def is_ignored(self, url):
+        return self.ignore_matcher is not None and self.ignore_matcher.search(url)
+
+    def record(self, new_title, new_url):
+        ''' Record one visit: +0.5 hit for the url, +0.25 for its parent. '''
+        with self.pending_lock:
+            if not self.loaded.is_set():
+                self.pending_visits.append((new_title, new_url))
+                return
+
+        with self.lock:
+            self._record(new_title, new_url)
+            self.write_journal()
+
+        self.maybe_compact()
+
+    def record_many(self, visits):
+        ''' Merge a batch of imported (title, url) pages without journaling them, call save() once done.
+
+        Unlike record(), parents are not bumped and pages hit once are kept,
+        return number of pages stored.
+        '''
+        self.loaded.wait()
+        stored = 0
+        with self.lock:
+            for (new_title, new_url) in visits:
+                key = self.url_key(new_url)
+                if key is None or self.is_ignored(new_url):
+                    continue
+
+                if key in self.pages:
+                    self.rename(key, new_title, new_url)
+                    self.bump(key, 0.5)
+                else:
+                    self.add(HistoryPage(new_title, new_url, 1))
+                stored += 1
+
+            if self.search_index is not None and self.search_index.need_rebuild():
+                self.build_search_index()
+        return stored
+
+    def _record(self, new_title, new_url):
+        with self.lock:
+            key = self.url_key(new_url)
+            if key is not None:
+                parent_key = self.parent_key(key)
+                if parent_key in self.pages and not self.is_ignored(self.pages[parent_key].url):
+                    self.bump(parent_key, 0.25)
+
+                if self.is_ignored(new_url):
+                    self.remove(key)
+                elif key in self.pages:
+                    self.rename(key, new_title, new_url)
+                    self.bump(key, 0.5)
+                    self.pages[key].visit_time = time.time()
+                else:
+                    self.add(HistoryPage(new_title, new_url, 1, time.time()))
+                    self.weak_keys.add(key)
+
+            # Pages only hit once are forgotten once another page is visited.
+            for weak_key in list(self.weak_keys):
+                page = self.pages.get(weak_key)
+                if page is None or page.hit > 1:
+                    self.weak_keys.discard(weak_key)
+                elif page.url != new_url:
+                    self.remove(weak_key)
+
+            if self.search_index is not None and self.search_index.need_rebuild():
+                self.build_search_index()
+
+    def build_search_index(self):
+        with self.lock:
+            self.search_index = HistorySearchIndex()
+            for (key, page) in self.pages.items():
+                self.search_index.add(key, page)
+            self.last_search = None
+
+    def score(self, page):
+        ''' Hit score, boosted for pages visited recently in this session. '''
+        if page.visit_time > 0:
+            return page.hit * (1 + 1 / (1 + (time.time() - page.visit_time) / 3600))
+        return page.hit
+
+    def search(self, query, limit):
+        ''' Return the limit best pages containing every word of query in their title or url. '''
+        query = query.lower().strip()
+        tokens = query.split()
+        if len(tokens) == 0:
+            return self.top(limit)
+
+        with self.lock:
+            if self.search_index is None:
+                return []
+
+            # Typing forward only narrows the previous result.
+            if self.last_search is not None and \
+               self.last_search[1] == self.search_generation and \
+               query.startswith(self.last_search[0]):
+                candidates = self.last_search[2]
+            else:
+                candidates = self.search_index.candidates(tokens)
+
+            if candidates is None:
+                # Words are too short for the index, scan by hit and stop at limit.
+                matches = []
+                for (_, key) in self.ranking:
+                    haystack = HistorySearchIndex.haystack(self.pages[key])
+                    if all(token in haystack for token in tokens):
+                        matches.append(key)
+                        if len(matches) >= limit:
+                            break
+            else:
+                matches = [key for key in candidates
+                           if key in self.pages and
+                           all(token in HistorySearchIndex.haystack(self.pages[key]) for token in tokens)]
+                self.last_search = (query, self.search_generation, matches)
+
+            return heapq.nlargest(limit, [self.pages[key] for key in matches], key=self.score)
+
+    def find(self, url):
+        ''' Return page of url, None if url is not in history. '''
+        with self.lock:
+            return self.pages.get(self.url_key(url) or url)
+
+    def top(self, limit):
+        ''' Return the limit pages with the highest hit. '''
+        with self.lock:
+            return [self.pages[key] for (_, key) in self.ranking[:limit]]
+
+    def write_journal(self):
+        ''' Append pages changed since the last call, one line per page. '''
+        records = ["ᛝ" + url + "ᛡ-\n" for url in self.removed_urls]
+        for key in self.changed_keys:
+            page = self.pages[key]
+            records.append(page.title + "ᛝ" + page.url + "ᛡ" + str(page.hit) + "\n")
+        self.changed_keys.clear()
+        self.removed_urls.clear()
+
+        if len(records) > 0:
+            if self.journal_file is None:
+                self.journal_file = open(self.journal_file_path, "a", encoding="utf-8")
+            self.journal_file.writelines(records)
+            self.journal_file.flush()
+            self.journal_records += len(records)
+
+    def maybe_compact(self):
+        if self.journal_records >= self.COMPACT_THRESHOLD and \
+           (self.compact_thread is None or not self.compact_thread.is_alive()):
+            self.compact_thread = threading.Thread(target=self.compact)
+            self.compact_thread.start()
+
+    def save(self):
+        ''' Write the whole store to snapshot, used after record_many(). '''
+        self.compact(journal_changes=False)
+
+    def compact(self, journal_changes=True):
+        ''' Fold journal into snapshot, the snapshot is replaced by atomic rename. '''
+        with self.write_lock:
+            self._compact(journal_changes)
+
+    def _compact(self, journal_changes):
+        with self.lock:
+            if journal_changes:
+                self.write_journal()
+            else:
+                # Snapshot below contains these changes already.
+                self.changed_keys.clear()
+                self.removed_urls.clear()
+            if self.journal_file is not None:
+                self.journal_file.close()
+                self.journal_file = None
+
+            if os.path.exists(self.journal_file_path):
+                if os.path.exists(self.compacting_file_path):
+                    # Previous compaction did not finish, keep its records too.
+                    with open(self.compacting_file_path, "a", encoding="utf-8") as compacting_file, \
+                         open(self.journal_file_path, "r", encoding="utf-8") as journal_file:
+                        compacting_file.write(journal_file.read())
+                    os.remove(self.journal_file_path)
+                else:
+                    os.replace(self.journal_file_path, self.compacting_file_path)
+            self.journal_records = 0
+
+            snapshot = [(page.title, page.url, page.hit) for page in self]
+
+        tmp_file_path = self.log_file_path + ".tmp"
+        with open(tmp_file_path, "w", encoding="utf-8") as f:
+            f.writelines(map(lambda history: history[0] + "ᛝ" + history[1] + "ᛡ" + str(history[2]) + "\n", snapshot))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file_path, self.log_file_path)
+
+        if os.path.exists(self.compacting_file_path):
+            os.remove(self.compacting_file_path)
+
+    def clear(self):
+        with self.write_lock, self.lock:
+            if self.journal_file is not None:
+                self.journal_file.close()
+                self.journal_file = None
+
+            for file_path in [self.log_file_path, self.journal_file_path, self.compacting_file_path]:
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+
+            self.pages = {}
+            self.ranking = []
+            self.weak_keys = set()
+            self.changed_keys.clear()
+            self.removed_urls.clear()
+            self.journal_records = 0
+
+            self.search_index = HistorySearchIndex()
+            self.search_generation += 1
+            self.last_search = None
+
+    def __iter__(self):
+        for (_, key) in self.ranking:
+            yield self.pages[key]
+
+    def __len__(self):
+        return len(self.pages)
+
+class HistoryImporter():
+    ''' Import history of other browsers into HistoryStore.
+
+    Every browser has a watermark file with the newest visit time imported,
+    only visits after it are read on the next import, so syncing costs time
+    proportional to the new visits.
+    '''
+
+    # Drop duplications with same title in SQL, keep url of lastest visit.
+    queries = {
+        "chrome": '''select title, url, max(last_visit_time) from urls
+                  where title is not null and title != '' and last_visit_time > ?
+                  group by title order by last_visit_time asc''',
+        "firefox": '''select title, url, max(last_visit_date) from moz_places
+                   where title is not null and title != '' and last_visit_date > ?
+                   group by title order by last_visit_date asc'''
+    }
+
+    sync_browsers = ["chrome", "firefox"]
+    sync_thread = None
+
+    # browser name -> lock, manual import and sync thread read the same watermark.
+    source_locks = {}
+    source_locks_lock = threading.Lock()
+
+    def __init__(self, history_store, config_dir):
+        self.history_store = history_store
+        self.config_dir = config_dir
+
+    def watermark_path(self, browser_name):
+        if browser_name == "safari":
+            filename = "safari_history_last_update_time.txt"
+        else:
+            filename = "{}_history_last_visit_time.txt".format(browser_name)
+        return os.path.join(os.path.dirname(self.config_dir), "browser", filename)
+
+    def read_watermark(self, browser_name):
+        watermark_path = self.watermark_path(browser_name)
+        if os.path.exists(watermark_path):
+            with open(watermark_path, "r", encoding="utf-8") as f:
+                try:
+                    return float(f.read())
+                except ValueError as e:
+                    message_to_emacs("Failed to read {}, error: {}".format(os.path.basename(watermark_path), e))
+        return 0
+
+    def write_watermark(self, browser_name, watermark):
+        with open(self.watermark_path(browser_name), "w") as f:
+            f.write(str(watermark))
+
+    def connect(self, dbpath):
+        import sqlite3
+
+        # Read-only and immutable, so a running browser's lock doesn't abort the import.
+        return sqlite3.connect("file:{}?mode=ro&immutable=1".format(urllib.parse.quote(dbpath)), uri=True)
+
+    @classmethod
+    def source_lock(cls, browser_name):
+        with cls.source_locks_lock:
+            return cls.source_locks.setdefault(browser_name, threading.Lock())
+
+    def import_history(self, browser_name, dbpath, verbose=True):
+        ''' Import visits of browser_name newer than its watermark, return number of entries imported. '''
+        with self.source_lock(browser_name):
+            return self._import_history(browser_name, dbpath, verbose)
+
+    def _import_history(self, browser_name, dbpath, verbose):
+        import sqlite3
+
+        if verbose:
+            message_to_emacs("Importing from {}...".format(dbpath))
+
+        # Merge history in chunks, never hold whole history db in memory.
+        chunk_size = 1000
+
+        imported = 0
+        conn = self.connect(dbpath)
+        try:
+            if browser_name == "safari":
+                chunks = self.read_safari_history(conn, chunk_size)
+            else:
+                chunks = self.read_history(conn, browser_name, chunk_size)
+
+            watermark = None
+            report_time = time.time()
+            for (chunk, watermark) in chunks:
+                imported += self.history_store.record_many(chunk)
+
+                if verbose and time.time() - report_time > 1:
+                    message_to_emacs("Importing {} entries ...".format(imported))
+                    report_time = time.time()
+
+            if imported > 0:
+                self.history_store.save()
+
+            # Only move watermark after entries are saved, a failed import is read again next time.
+            if watermark is not None:
+                self.write_watermark(browser_name, watermark)
+
+            if verbose:
+                message_to_emacs("{} {} history entries imported.".format(imported, browser_name))
+        except sqlite3.OperationalError as e:
+            message_to_emacs("Failed to read {} history entries: {}.".format(browser_name, e))
+        finally:
+            conn.close()
+
+        return imported
+
+    def read_history(self, conn, browser_name, chunk_size):
+        ''' Yield (entries, watermark) chunks, watermark is the newest visit time read so far. '''
+        watermark = self.read_watermark(browser_name)
+        cursor = conn.execute(self.queries[browser_name], (watermark, ))
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if len(rows) == 0:
+                break
+
+            # Rows are ordered by visit time.
+            watermark = max(watermark, rows[-1][2])
+            yield ([(title, url) for (title, url, _) in rows], watermark)
+
+    def read_safari_history(self, conn, chunk_size):
+        cursor = conn.cursor()
+        history_items = cursor.execute('SELECT id, url FROM history_items').fetchall()
+        history_visits = cursor.execute('SELECT history_item, visit_time, title FROM history_visits order by visit_time asc').fetchall()
+
+        max_visit_time = self.read_watermark("safari")
+
+        _histories = {}
+        histories = {}
+        for id, url in history_items:
+            _histories[id] = [url, '']
+
+        for history_item, visit_time, title  in history_visits:
+            if visit_time < max_visit_time:
+                continue
+
+            if history_item not in _histories:
+                message_to_emacs("Parse safari history file error.")
+                return
+
+            _histories[history_item][-1] = (title)
+
+        watermark = history_visits[-1][1] if len(history_visits) > 0 else max_visit_time
+
+        for id, url in history_items:
+            url, title = _histories[id]
+            if title is not None and len(title) > 0:
+                histories[title] = url
+
+        histories = list(histories.items())
+        for i in range(0, len(histories), chunk_size):
+            yield (histories[i:i + chunk_size], watermark)
+
+    @classmethod
+    def start_sync(cls, importer, sources, interval):
+        ''' Import (browser_name, dbpath) sources every interval minutes, only started once per process. '''
+        if cls.sync_thread is not None or interval <= 0:
+            return
+
+        def sync():
+            while True:
+                time.sleep(interval * 60)
+                for (browser_name, dbpath) in sources:
+                    if os.path.exists(dbpath):
+                        importer.import_history(browser_name, dbpath, verbose=False)
+
+        cls.sync_thread = threading.Thread(target=sync, daemon=True)
+        cls.sync_thread.start()
 
 class PasswordDb(object):
+    ''' Saved passwords, one connection shared by all browser buffers.
+
+    Rows are cached per host in memory and a host is reloaded after writing
+    it, so autofill after page load doesn't touch disk.
+    '''
+
+    instance = None
+    instance_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, dbpath):
+        with cls.instance_lock:
+            if cls.instance is None:
+                cls.instance = cls(dbpath)
+            return cls.instance
+
     def __init__(self, dbpath):
         import sqlite3
 
-        self._conn = sqlite3.connect(dbpath)
-        self._conn.execute("""
-        CREATE TABLE IF NOT EXISTS autofill
-        (id INTEGER PRIMARY KEY AUTOINCREMENT, host TEXT,
-         password TEXT, form_data TEXT)
-        """)
+        # Transactions are explicit, see transaction().
+        self._conn = sqlite3.connect(dbpath, isolation_level=None, check_same_thread=False)
+        self._lock = threading.RLock()
 
-    def add_entry(self, host, password, form_data):
-        result = self._conn.execute("""
-        SELECT id, host, password, form_data FROM autofill
-        WHERE host=? AND form_data=? ORDER BY id
-        """, (host, str(form_data)))
-        if len(list(result))>0:
+        # WAL lets readers work while a write is committed, NORMAL sync is safe with WAL.
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self.transaction():
             self._conn.execute("""
-            UPDATE autofill SET password=?
-            WHERE host=? and form_data=?
-            """, (password, host, str(form_data)))
-        else:
+            CREATE TABLE IF NOT EXISTS autofill
+            (id INTEGER PRIMARY KEY AUTOINCREMENT, host TEXT,
+             password TEXT, form_data TEXT)
+            """)
             self._conn.execute("""
-            INSERT INTO autofill (host, password, form_data)
-            VALUES (?, ?, ?)
-            """, (host, password, str(form_data)))
-            self._conn.commit()
+            CREATE INDEX IF NOT EXISTS autofill_host_form_data ON autofill (host, form_data)
+            """)
+
+        # host -> rows ordered by id, hosts without rows are cached too.
+        self._host_cache = {}
+        for row in self._conn.execute("SELECT id, host, password, form_data FROM autofill ORDER BY id"):
+            self._host_cache.setdefault(row[1], []).append(row)
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def add_entry(self, host, password, form_data):
+        self.add_entries([(host, password, form_data)])
+
+    def add_entries(self, entries):
+        ''' Insert or update (host, password, form_data) entries in one transaction. '''
+        with self.transaction():
+            for (host, password, form_data) in entries:
+                cursor = self._conn.execute("""
+                UPDATE autofill SET password=?
+                WHERE host=? and form_data=?
+                """, (password, host, str(form_data)))
+                if cursor.rowcount == 0:
+                    self._conn.execute("""
+                    INSERT INTO autofill (host, password, form_data)
+                    VALUES (?, ?, ?)
+                    """, (host, password, str(form_data)))
+
+            for host in set(map(lambda entry: entry[0], entries)):
+                self._host_cache[host] = self._conn.execute("""
+                SELECT id, host, password, form_data FROM autofill
+                WHERE host=? ORDER BY id
+                """, (host, )).fetchall()
 
     def get_entries(self, host, id):
-        return self._conn.execute("""
-        SELECT id, host, password, form_data FROM autofill
-        WHERE host=? and id>? ORDER BY id
-        """, (host, id))
+        with self._lock:
+            rows = self._host_cache.get(host, [])
+        return [row for row in rows if row[0] > id]
+
+def get_process_memory():
+    ''' Return resident memory of browser process in bytes, None if unknown. '''
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+class AdBlockFilterList():
+    ''' One filter list of eaf-browser-adblock-filter-lists.
+
+    Source is a path relative to browser directory, a file:// url, or a
+    http(s) url downloaded into cache_dir. A list expires expiry_days after
+    it was fetched, local lists are reloaded when they change on disk.
+    '''
+
+    def __init__(self, source, expiry_days, cache_dir):
+        import hashlib
+        import urllib.request
+
+        self.source = source
+        self.expiry_days = float(expiry_days)
+        self.is_remote = source.startswith("http://") or source.startswith("https://")
+
+        if self.is_remote:
+            self.path = os.path.join(cache_dir, "lists", hashlib.sha1(source.encode("utf-8")).hexdigest() + ".txt")
+        elif source.startswith("file://"):
+            self.path = urllib.request.url2pathname(urllib.parse.urlparse(source).path)
+        else:
+            self.path = os.path.join(os.path.dirname(__file__), os.path.expanduser(source))
+
+        self.mtime = None
+        self.stats = {}
+
+    def is_stale(self):
+        if not os.path.exists(self.path):
+            return self.is_remote
+        mtime = os.stat(self.path).st_mtime
+        if self.is_remote:
+            return time.time() - mtime > self.expiry_days * 86400
+        return mtime != self.mtime
+
+    def fetch(self):
+        import urllib.request
+
+        try:
+            with urllib.request.urlopen(self.source, timeout=30) as response:
+                content = response.read()
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + ".tmp", "wb") as f:
+                f.write(content)
+            os.replace(self.path + ".tmp", self.path)
+        except OSError as e:
+            # Keep using stale copy if there is one.
+            message_to_emacs("Failed to update adblock filter list {}: {}".format(self.source, e))
+
+    def read(self):
+        start_time = time.time()
+        if self.is_remote and self.is_stale():
+            self.fetch()
+
+        with open(self.path, "rb") as f:
+            raw_rules = f.read()
+        self.mtime = os.stat(self.path).st_mtime
+
+        self.stats = {"bytes": len(raw_rules),
+                      "rules": raw_rules.count(b"\n"),
+                      "read_time": time.time() - start_time}
+        return raw_rules
+
+def style_script(name, style_id, stylesheet, prelude="", epilogue="", on_insert=""):
+    ''' Return QWebEngineScript inserting stylesheet at document creation, in application world.
+
+    prelude runs before style is created and may return, epilogue can use the style element,
+    on_insert runs once style is in document and its sheet is parsed.
+    '''
+    # Document may have no root element yet at document creation, insert style once it has.
+    source = '''(function() {{
+{prelude}
+var style = document.createElement("style");
+style.id = {style_id};
+style.textContent = {stylesheet};
+function insertStyle() {{
+    var root = document.head || document.documentElement;
+    if (root) {{
+        root.appendChild(style);
+        {on_insert}
+    }}
+    return root;
+}}
+if (!insertStyle()) {{
+    new MutationObserver(function(mutations, observer) {{
+        if (insertStyle()) {{
+            observer.disconnect();
+        }}
+    }}).observe(document, {{childList: true, subtree: true}});
+}}
+{epilogue}
+}})();'''.format(prelude=prelude, epilogue=epilogue, on_insert=on_insert, style_id=json.dumps(style_id), stylesheet=json.dumps(stylesheet))
+
+    script = QWebEngineScript()
+    script.setName(name)
+    script.setSourceCode(source)
+    script.setInjectionPoint(QWebEngineScript.InjectionPoint.DocumentCreation)
+    # Keep flags and observer out of page's reach.
+    script.setWorldId(QWebEngineScript.ScriptWorldId.ApplicationWorld)
+    return script
+
+class AdBlockCosmeticFilter():
+    ''' Element hiding rules (## and #@#) of filter lists, precomputed into stylesheets.
+
+    Generic selectors make one stylesheet registered in profile for main frames,
+    selectors of a host and its parent domains make a stylesheet cached per host.
+    Both are inserted at document creation, so hidden elements are never laid out.
+    A host excepting generic selectors only deletes their rules from generic stylesheet.
+    Procedural rules (#?#, #$#, :has-text()...) need a script engine and are skipped.
+    '''
+
+    rule_re = re.compile(r'^([\w.,~-]*)#(@?)#(.+)$', re.MULTILINE)
+    procedural_re = re.compile(r':(?:-abp-|has-text\(|contains\(|xpath\(|upward\(|remove\(|style\(|matches-|'
+                               r'min-text-length\(|watch-attr\(|nth-ancestor\(|others\(|if\(|if-not\()')
+
+    HOST_CACHE_SIZE = 256
+
+    generic_script_name = "eaf-adblock-cosmetic:generic"
+    host_script_name = "eaf-adblock-cosmetic:host"
+
+    def __init__(self, raw_rules_list):
+        start_time = time.time()
+
+        self.generic_selectors = set()
+        self.generic_exceptions = set()
+        self.host_selectors = {}   # host -> selectors hidden on host and its subdomains
+        self.host_exceptions = {}  # host -> selectors not hidden on host and its subdomains
+        self.skipped = 0
+
+        for raw_rules in raw_rules_list:
+            for (domains, exception, selector) in self.rule_re.findall(raw_rules.decode("utf-8", "ignore")):
+                if ("{" in selector or "}" in selector or selector.startswith("+js(") or selector.startswith("^")
+                    or self.procedural_re.search(selector)):
+                    self.skipped += 1
+                    continue
+
+                include_hosts = []
+                exclude_hosts = []
+                for domain in domains.split(","):
+                    if domain.startswith("~"):
+                        exclude_hosts.append(domain[1:])
+                    elif domain != "":
+                        include_hosts.append(domain)
+
+                if exception:
+                    if len(include_hosts) > 0:
+                        for host in include_hosts:
+                            self.host_exceptions.setdefault(host, set()).add(selector)
+                    else:
+                        self.generic_exceptions.add(selector)
+                else:
+                    if len(include_hosts) > 0:
+                        for host in include_hosts:
+                            self.host_selectors.setdefault(host, set()).add(selector)
+                    else:
+                        self.generic_selectors.add(selector)
+                    # ~host disables rule on host, same as an exception of host.
+                    for host in exclude_hosts:
+                        self.host_exceptions.setdefault(host, set()).add(selector)
+
+        self.generic_selectors -= self.generic_exceptions
+        self.generic_stylesheet = self.stylesheet(self.generic_selectors)
+
+        # host -> (stylesheet or None, stylesheet of generic rules excepted on host or None)
+        self.host_cache = LruCache(self.HOST_CACHE_SIZE)
+
+        self.stats = {"generic_selectors": len(self.generic_selectors),
+                      "hosts": len(self.host_selectors),
+                      "skipped": self.skipped,
+                      "generic_size": len(self.generic_stylesheet),
+                      "parse_time": time.time() - start_time}
+
+    def stylesheet(self, selectors):
+        # One rule per selector, an invalid selector only drops its own rule.
+        return "\n".join(map(lambda selector: selector + "{display:none!important}", sorted(selectors)))
+
+    def host_stylesheet(self, host):
+        ''' Return stylesheet of host and generic rules it excepts, cached per host. '''
+        result = self.host_cache.get(host)
+        if result is not None:
+            return result
+
+        selectors = set()
+        exceptions = set()
+        # Lookup host and parent domains, www.example.com -> example.com -> com.
+        domain = host
+        while domain != "":
+            selectors.update(self.host_selectors.get(domain, ()))
+            exceptions.update(self.host_exceptions.get(domain, ()))
+            domain = domain.partition(".")[2]
+
+        unhide_selectors = exceptions & self.generic_selectors
+        selectors -= exceptions
+        selectors -= self.generic_exceptions
+
+        result = (self.stylesheet(selectors) if len(selectors) > 0 else None,
+                  self.stylesheet(unhide_selectors) if len(unhide_selectors) > 0 else None)
+        self.host_cache.put(host, result)
+        return result
+
+    def generic_script(self):
+        # Host script may run before or after this one, rules it excepts are deleted by whichever runs last.
+        # Browser parses excepted selectors too, so they compare equal to selectorText of generic rules.
+        prelude = '''window.eafAdblockApplyUnhide = function() {
+    if (!window.eafAdblockUnhide || !style.sheet) {
+        return;
+    }
+    var unhide = new CSSStyleSheet();
+    unhide.replaceSync(window.eafAdblockUnhide);
+    window.eafAdblockUnhide = null;
+    var selectors = new Set(Array.from(unhide.cssRules, function(rule) { return rule.selectorText; }));
+    var rules = style.sheet.cssRules;
+    for (var i = rules.length - 1; i >= 0; i--) {
+        if (selectors.has(rules[i].selectorText)) {
+            style.sheet.deleteRule(i);
+        }
+    }
+};'''
+        script = style_script(self.generic_script_name, "eaf-adblock-cosmetic-generic", self.generic_stylesheet,
+                              prelude=prelude, on_insert="window.eafAdblockApplyUnhide();")
+        # Sub frames would each parse the whole generic stylesheet, only main frame gets it.
+        script.setRunsOnSubFrames(False)
+        return script
+
+    def host_script(self, host):
+        ''' Return QWebEngineScript hiding elements of host in main frame, None if host has no rules. '''
+        (stylesheet, unhide_stylesheet) = self.host_stylesheet(host)
+        if stylesheet is None and unhide_stylesheet is None:
+            return None
+
+        # Script of previous host may still be registered when navigation commits, check host first.
+        prelude = "if (location.hostname !== {}) return;".format(json.dumps(host))
+        if unhide_stylesheet is not None:
+            prelude += '''
+window.eafAdblockUnhide = {};
+if (window.eafAdblockApplyUnhide) {{
+    window.eafAdblockApplyUnhide();
+}}'''.format(json.dumps(unhide_stylesheet))
+        script = style_script(self.host_script_name, "eaf-adblock-cosmetic-host", stylesheet or "", prelude=prelude)
+        script.setRunsOnSubFrames(False)
+        return script
+
+class AdBlockEngine():
+    ''' Filter lists compiled by adblock-rust.
+
+    With python-adblock the compiled engine is serialized into cache_dir,
+    keyed by the hash of all rules, so later starts skip rule parsing.
+    '''
+
+    def __init__(self, filter_lists, cache_dir):
+        import hashlib
+
+        start_time = time.time()
+        start_memory = get_process_memory()
+
+        rules_hash = hashlib.sha1()
+        raw_rules_list = []
+        for filter_list in filter_lists:
+            try:
+                raw_rules = filter_list.read()
+            except OSError as e:
+                message_to_emacs("Failed to read adblock filter list {}: {}".format(filter_list.source, e))
+                continue
+            rules_hash.update(raw_rules)
+            raw_rules_list.append((filter_list, raw_rules))
+        rules_hash = rules_hash.hexdigest()
+
+        self.filter_lists = [filter_list for (filter_list, _) in raw_rules_list]
+        # Element hiding rules are applied by stylesheets, not by adblock-rust.
+        self.cosmetic_filter = AdBlockCosmeticFilter([raw_rules for (_, raw_rules) in raw_rules_list])
+        self.from_cache = False
+        self.cache_size = None
+
+        if found_adblock:
+            cache_path = os.path.join(cache_dir, "engine-{}.dat".format(rules_hash))
+            self.engine = adblock.Engine(adblock.FilterSet())
+            if os.path.exists(cache_path):
+                try:
+                    self.engine.deserialize_from_file(cache_path)
+                    self.from_cache = True
+                    self.cache_size = os.path.getsize(cache_path)
+                except Exception:
+                    os.remove(cache_path)
+
+            if not self.from_cache:
+                filter_set = adblock.FilterSet()
+                for (filter_list, raw_rules) in raw_rules_list:
+                    list_start_time = time.time()
+                    list_start_memory = get_process_memory()
+                    filter_set.add_filter_list(raw_rules.decode("utf-8", "ignore"))
+                    filter_list.stats["parse_time"] = time.time() - list_start_time
+                    if list_start_memory is not None:
+                        filter_list.stats["memory"] = get_process_memory() - list_start_memory
+                # Raw rules are parsed into filter_set, drop every reference so they're freed before compile.
+                raw_rules_list = raw_rules = None
+                self.engine = adblock.Engine(filter_set)
+                self.save_cache(cache_dir, cache_path)
+        else:
+            rules = []
+            for (filter_list, raw_rules) in raw_rules_list:
+                rules += raw_rules.decode("utf-8", "ignore").splitlines()
+            raw_rules_list = raw_rules = None
+            self.engine = braveblock.Adblocker(rules=rules)
+
+        self.stats = {"compile_time": time.time() - start_time,
+                      "from_cache": self.from_cache}
+        if start_memory is not None:
+            self.stats["memory"] = get_process_memory() - start_memory
+
+    def save_cache(self, cache_dir, cache_path):
+        os.makedirs(cache_dir, exist_ok=True)
+        # Caches of old rules are useless.
+        for filename in os.listdir(cache_dir):
+            if filename.startswith("engine-") and filename.endswith(".dat"):
+                os.remove(os.path.join(cache_dir, filename))
+        self.engine.serialize_to_file(cache_path + ".tmp")
+        os.replace(cache_path + ".tmp", cache_path)
+        self.cache_size = os.path.getsize(cache_path)
+
+    def is_stale(self):
+        for filter_list in self.filter_lists:
+            if filter_list.is_stale():
+                return True
+        return False
+
+    def check(self, url, source_url, request_type):
+        ''' Return whether to block url, and the matched filter if engine reports it. '''
+        try:
+            if found_adblock:
+                result = self.engine.check_network_urls(url, source_url, request_type)
+                return (result.matched, getattr(result, "filter", None))
+            else:
+                return (self.engine.check_network_urls(url=url, source_url=source_url, request_type=request_type), None)
+        except Exception:
+            # Never let a url the engine can't parse break page loading.
+            return (False, None)
+
+class AdBlockStats():
+    ''' Latency histogram, per host counts, cache hit ratio and slowest requests of adblock decisions.
+
+    Recent requests are kept as corpus, save_corpus() writes them in the
+    format replayed by adblock_benchmark.py.
+    '''
+
+    # Upper bounds of latency buckets in microseconds, last bucket has no bound.
+    BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+    SLOWEST_SIZE = 20
+    CORPUS_SIZE = 10000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        self.histogram = [0] * (len(self.BUCKETS) + 1)
+        self.blocked_hosts = {}
+        self.allowed_hosts = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.slowest = []  # min heap of (latency, url, request type, matched filter) of engine checks
+        self.corpus = deque(maxlen=self.CORPUS_SIZE)
+
+    def add(self, url, source_url, request_type, block, latency, cached, matched_filter):
+        host = QUrl(url).host()
+        with self.lock:
+            self.histogram[bisect.bisect_left(self.BUCKETS, latency * 1000000)] += 1
+
+            hosts = self.blocked_hosts if block else self.allowed_hosts
+            hosts[host] = hosts.get(host, 0) + 1
+
+            if cached:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+                slow_request = (latency, url, request_type, matched_filter or "")
+                if len(self.slowest) < self.SLOWEST_SIZE:
+                    heapq.heappush(self.slowest, slow_request)
+                else:
+                    heapq.heappushpop(self.slowest, slow_request)
+
+            self.corpus.append((url, source_url, request_type))
+
+    def percentile(self, percent):
+        ''' Return upper bound of latency bucket holding percent of requests, in microseconds. '''
+        total = sum(self.histogram)
+        count = 0
+        for (index, bucket_count) in enumerate(self.histogram):
+            count += bucket_count
+            if total > 0 and count >= total * percent / 100:
+                return self.BUCKETS[index] if index < len(self.BUCKETS) else float("inf")
+        return 0
+
+    def report(self):
+        with self.lock:
+            total = self.cache_hits + self.cache_misses
+            lines = ["Requests: {}, blocked: {}, allowed: {}".format(
+                total, sum(self.blocked_hosts.values()), sum(self.allowed_hosts.values())),
+                     "Cache hit ratio: {:.1f}%".format(self.cache_hits * 100 / total if total > 0 else 0),
+                     "Latency p50: <={}us, p99: <={}us".format(self.percentile(50), self.percentile(99)),
+                     "",
+                     "Latency histogram:"]
+            for (index, bucket_count) in enumerate(self.histogram):
+                bound = "<={}us".format(self.BUCKETS[index]) if index < len(self.BUCKETS) else ">{}us".format(self.BUCKETS[-1])
+                lines.append("  {:>9} {:>8}".format(bound, bucket_count))
+
+            for (title, hosts) in [("Most blocked hosts:", self.blocked_hosts), ("Most allowed hosts:", self.allowed_hosts)]:
+                lines.append("")
+                lines.append(title)
+                for (host, count) in heapq.nlargest(20, hosts.items(), key=lambda item: item[1]):
+                    lines.append("  {:>8} {}".format(count, host))
+
+            lines.append("")
+            lines.append("Slowest engine checks:")
+            for (latency, url, request_type, matched_filter) in sorted(self.slowest, reverse=True):
+                lines.append("  {:>8.0f}us {:<14} {} {}".format(latency * 1000000, request_type, url, matched_filter))
+        return "\n".join(lines)
+
+    def save_corpus(self, corpus_path):
+        with self.lock:
+            corpus = list(self.corpus)
+        os.makedirs(os.path.dirname(corpus_path), exist_ok=True)
+        with open(corpus_path, "w", encoding="utf-8") as f:
+            f.writelines(map(lambda request: "\t".join(request) + "\n", corpus))
+        return len(corpus)
+
+class AdBlockManager():
+    ''' Owns the AdBlockEngine shared by all interceptors.
+
+    Engine is built on a worker thread and swapped in by one assignment, so
+    interceptRequest never waits for lists to compile, requests are allowed
+    until the first engine is ready. Filter lists are checked every
+    CHECK_INTERVAL seconds and the engine is rebuilt once one is stale.
+    '''
+
+    CHECK_INTERVAL = 600
+    DECISION_CACHE_SIZE = 4096
+
+    instance = None
+    instance_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, cache_dir, filter_list_specs):
+        with cls.instance_lock:
+            if cls.instance is None:
+                cls.instance = cls(cache_dir, filter_list_specs)
+            return cls.instance
+
+    def __init__(self, cache_dir, filter_list_specs):
+        self.cache_dir = cache_dir
+        self.filter_list_specs = filter_list_specs
+        self.engine = None
+        self.generation = 0  # increased when engine is swapped
+        self.rebuild_lock = threading.Lock()
+
+        # (url, first party host, request type) -> block, only valid for decision_cache_generation.
+        self.decision_cache = LruCache(self.DECISION_CACHE_SIZE)
+        self.decision_cache_generation = 0
+        self.decision_cache_lock = threading.Lock()
+
+        self.stats = AdBlockStats()
+        # Stats cost time on every request, only recorded when user asks for them.
+        self.collect_stats = bool(BrowserConfig.get("eaf-browser-adblock-collect-stats"))
+
+        self.cosmetic_installed = {}  # profile -> generation of generic stylesheet installed in profile
+
+        self.rebuild()
+        threading.Thread(target=self.check_filter_lists, daemon=True).start()
+
+    def rebuild(self):
+        ''' Build new engine in background, ignored if a build is running already. '''
+        threading.Thread(target=self._rebuild).start()
+
+    def _rebuild(self):
+        if not self.rebuild_lock.acquire(blocking=False):
+            return
 
-if found_braveblock:
-    with open(os.path.join(os.path.dirname(__file__), "easylist.txt"), encoding="utf8") as f:
-        raw_rules = f.readlines()
-        easylist_adblocker = braveblock.Adblocker(rules=raw_rules)
+        try:
+            filter_lists = [AdBlockFilterList(source, expiry_days, self.cache_dir)
+                            for (source, expiry_days) in self.filter_list_specs]
+            engine = AdBlockEngine(filter_lists, self.cache_dir)
+            self.engine = engine
+            self.generation += 1
+        except Exception as e:
+            message_to_emacs("Failed to build adblock engine: {}".format(e))
+        finally:
+            self.rebuild_lock.release()
+
+    def check_filter_lists(self):
+        while True:
+            time.sleep(self.CHECK_INTERVAL)
+            engine = self.engine
+            if engine is not None and engine.is_stale():
+                self._rebuild()
+
+    def should_block(self, url, source_url, request_type):
+        engine = self.engine
+        if engine is None:
+            return False
+
+        start_time = time.perf_counter() if self.collect_stats else None
+        matched_filter = None
+
+        key = (url, QUrl(source_url).host(), request_type)
+        with self.decision_cache_lock:
+            if self.decision_cache_generation != self.generation:
+                self.decision_cache.clear()
+                self.decision_cache_generation = self.generation
+
+            block = self.decision_cache.get(key)
+            cached = block is not None
+
+        if not cached:
+            (block, matched_filter) = engine.check(url, source_url, request_type)
+
+            with self.decision_cache_lock:
+                if self.decision_cache_generation == self.generation:
+                    self.decision_cache.put(key, block)
+
+        if start_time is not None:
+            self.stats.add(url, source_url, request_type, block, time.perf_counter() - start_time, cached, matched_filter)
+        return block
+
+    def install_cosmetic_filter(self, profile):
+        ''' Register generic element hiding stylesheet in profile, only done again after engine is swapped. '''
+        generation = self.generation
+        engine = self.engine
+        if engine is None or self.cosmetic_installed.get(profile) == generation:
+            return
+
+        profile_scripts = profile.scripts()
+        for script in profile_scripts.find(AdBlockCosmeticFilter.generic_script_name):
+            profile_scripts.remove(script)
+        profile_scripts.insert(engine.cosmetic_filter.generic_script())
+
+        self.cosmetic_installed[profile] = generation
+
+    @classmethod
+    def uninstall_cosmetic_filter(cls, profile):
+        ''' Remove generic element hiding stylesheet from profile, it's registered again by install_cosmetic_filter(). '''
+        profile_scripts = profile.scripts()
+        for script in profile_scripts.find(AdBlockCosmeticFilter.generic_script_name):
+            profile_scripts.remove(script)
+        if cls.instance is not None:
+            cls.instance.cosmetic_installed.pop(profile, None)
+
+    def report(self):
+        engine = self.engine
+        if engine is None:
+            return "Adblock engine is building..."
+
+        def format_memory(memory):
+            return "unknown" if memory is None else "{:.1f}MB".format(memory / 1024 / 1024)
+
+        lines = ["Adblock engine (generation {}, {})".format(
+            self.generation, "loaded from cache" if engine.from_cache else "compiled"),
+                 "  compile time: {:.3f}s".format(engine.stats["compile_time"]),
+                 "  memory: {}".format(format_memory(engine.stats.get("memory"))),
+                 "  serialized size: {}".format(format_memory(engine.cache_size)),
+                 "",
+                 "Element hiding",
+                 "  generic selectors: {}, hosts: {}, skipped procedural rules: {}".format(
+                     engine.cosmetic_filter.stats["generic_selectors"],
+                     engine.cosmetic_filter.stats["hosts"],
+                     engine.cosmetic_filter.stats["skipped"]),
+                 "  generic stylesheet: {:.1f}KB".format(engine.cosmetic_filter.stats["generic_size"] / 1024),
+                 "  parse time: {:.3f}s".format(engine.cosmetic_filter.stats["parse_time"]),
+                 ""]
+        for filter_list in engine.filter_lists:
+            lines.append(filter_list.source)
+            lines.append("  path: {}".format(filter_list.path))
+            lines.append("  expiry: {} days".format(filter_list.expiry_days))
+            lines.append("  rules: {}, size: {:.1f}KB".format(filter_list.stats["rules"], filter_list.stats["bytes"] / 1024))
+            lines.append("  read time: {:.3f}s".format(filter_list.stats["read_time"]))
+            if "parse_time" in filter_list.stats:
+                lines.append("  parse time: {:.3f}s".format(filter_list.stats["parse_time"]))
+                lines.append("  memory: {}".format(format_memory(filter_list.stats.get("memory"))))
+            lines.append("")
+        if self.collect_stats:
+            lines.append(self.stats.report())
+        else:
+            lines.append("Request stats are off, set eaf-browser-adblock-collect-stats to record them.")
+        return "\n".join(lines)
 
 class AdBlockInterceptor(QWebEngineUrlRequestInterceptor):
+    # QtWebEngine resource type name -> request type of adblock filter options,
+    # names missing in the running Qt version are skipped.
+    request_type_names = {
+        "ResourceTypeMainFrame": "main_frame",
+        "ResourceTypeSubFrame": "sub_frame",
+        "ResourceTypeStylesheet": "stylesheet",
+        "ResourceTypeScript": "script",
+        "ResourceTypeImage": "image",
+        "ResourceTypeFontResource": "font",
+        "ResourceTypeSubResource": "other",
+        "ResourceTypeObject": "object",
+        "ResourceTypeMedia": "media",
+        "ResourceTypeWorker": "script",
+        "ResourceTypeSharedWorker": "script",
+        "ResourceTypePrefetch": "other",
+        "ResourceTypeFavicon": "image",
+        "ResourceTypeXhr": "xmlhttprequest",
+        "ResourceTypePing": "ping",
+        "ResourceTypeServiceWorker": "script",
+        "ResourceTypeCspReport": "csp_report",
+        "ResourceTypePluginResource": "object",
+        "ResourceTypeNavigationPreloadMainFrame": "main_frame",
+        "ResourceTypeNavigationPreloadSubFrame": "sub_frame",
+        "ResourceTypeWebSocket": "websocket",
+        "ResourceTypeUnknown": "other"
+    }
+    request_types = {getattr(QWebEngineUrlRequestInfo.ResourceType, name): request_type
+                     for (name, request_type) in request_type_names.items()
+                     if hasattr(QWebEngineUrlRequestInfo.ResourceType, name)}
+
     def __init__(self, profile, buffer):
         QWebEngineUrlRequestInterceptor.__init__(self)
-        profile.setUrlRequestInterceptor(self)
+        # Build shared engine on first interceptor, browser without adblocker won't pay for it.
+        self.manager = AdBlockManager.get(os.path.join(buffer.config_dir, "browser", "adblock"),
+                                          buffer.adblock_filter_lists)
         self.buffer = buffer
+        self.blocked = 0
+        self.allowed = 0
+
+        # Intercept requests of this page only when Qt supports it, so counts belong to this buffer.
+        if hasattr(buffer.buffer_widget.web_page, "setUrlRequestInterceptor"):
+            buffer.buffer_widget.web_page.setUrlRequestInterceptor(self)
+        else:
+            profile.setUrlRequestInterceptor(self)
+
+    def counts(self):
+        ''' Return (blocked, allowed) requests intercepted so far. '''
+        return (self.blocked, self.allowed)
 
     def interceptRequest(self, info):
         # Ad Test site:
@@ -811,39 +2939,210 @@ class AdBlockInterceptor(QWebEngineUrlRequestInterceptor):
             # We need use braveblock improve parse performance because braveblock implement by Rust.
             #
             # QWebEngineUrlRequestInterceptor will BLOCK main thread if this function is too slow.
-            if easylist_adblocker.check_network_urls(
+            #
+            # First party url and resource type let third-party, $script, $image... rules apply.
+            if self.manager.should_block(
                 url=url,
-                source_url="",  # do not set this url, source_url mean origin site to send ads
-                request_type=""):
+                source_url=info.firstPartyUrl().toString(),
+                request_type=self.request_types.get(info.resourceType(), "other")):
 
                 # print("Block Ad: ", url)
                 info.block(True)
+                self.blocked += 1
+            else:
+                self.allowed += 1
 
 class TampermonkeyScript():
-    # Currently, this class only supports match and export matching, and only supports regular expressions.
-    def __init__(self,filepath):
+    ''' Userscript with its metadata parsed and url rules compiled once.
+
+    @match uses match pattern syntax, @include and @exclude use glob syntax or
+    /regexp/, @export is a regexp matched from the start of the url.
+    @match using regexp syntax (.*, \\, parens, brackets...) is still matched as regexp.
+    Rules are tested by JavaScript RegExp, regexps using Python only syntax are rejected.
+    '''
+
+    header_re = re.compile(r'//\s*@(match|include|exclude|export|run-at|inject-into|noframes)(?:[ \t]+(\S*))?')
+
+    injection_points = {
+        "document-start": QWebEngineScript.InjectionPoint.DocumentCreation,
+        "document-body": QWebEngineScript.InjectionPoint.DocumentReady,
+        "document-end": QWebEngineScript.InjectionPoint.DocumentReady,
+        "document-idle": QWebEngineScript.InjectionPoint.Deferred
+    }
+    match_pattern_re = re.compile(r'^(\*|https?|file|ftp|wss?)://(\*|\*\.[^/*]+|[^/*]+)?(/.*)$')
+    # Scripts written for the old regexp-only matching use @match regexps like https://example.com/video/.*
+    legacy_match_re = re.compile(r'\.[*+]|[\\()\[\]{}+^$|]')
+    # Groups other than (?:, (?=, (?!, (?<=, (?<! and (?<name>, and \A \Z anchors, are not JavaScript syntax.
+    python_only_regexp_re = re.compile(r'(?<!\\)(?:\\\\)*(?:\(\?(?![:=!]|<[=!]|<[A-Za-z_])|\\[AZ])')
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.mtime = os.stat(filepath).st_mtime
+
         # Read the script's content
-        self.file_content = ""
-        with open(filepath,mode="r") as f:
+        with open(filepath, mode="r", encoding="utf-8") as f:
             self.file_content = f.read()
 
-        match_re = re.compile(r'// @match\s+(\S*)')
-        export_re = re.compile(r'// @export\s+(\S*)')
+        self.match_rules = []
+        self.include_rules = []
+        self.exclude_rules = []
+        self.export_rules = []
+        self.run_at = "document-end"
+        self.inject_into = "page"
+        self.noframes = False
+        for (key, value) in self.header_re.findall(self.file_content):
+            if key == "match":
+                self.match_rules.append(value)
+            elif key == "include":
+                self.include_rules.append(value)
+            elif key == "exclude":
+                self.exclude_rules.append(value)
+            elif key == "export":
+                self.export_rules.append(value)
+            elif key == "run-at":
+                self.run_at = value
+            elif key == "inject-into":
+                self.inject_into = value
+            elif key == "noframes":
+                self.noframes = True
+
+        include_regexps = list(map(self.compile_match_pattern, self.match_rules))
+        include_regexps += map(self.compile_glob, self.include_rules)
+
+        exclude_regexps = list(map(self.compile_glob, self.exclude_rules))
+        exclude_regexps += map(lambda export_rule: self.check_regexp(export_rule, "(?:" + export_rule + ").*"),
+                               self.export_rules)
+
+        # Drop rejected rules, an excluded url must never run the script because its rule was rejected.
+        include_regexps = [regexp for regexp in include_regexps if regexp is not None]
+        if None in exclude_regexps:
+            include_regexps = []
+        exclude_regexps = [regexp for regexp in exclude_regexps if regexp is not None]
+
+        # JavaScript regexps, Python re can't compile some of them, e.g. (?<name>).
+        self.include_regexp = self.compile_alternation(include_regexps)
+        self.exclude_regexp = self.compile_alternation(exclude_regexps)
+
+    def compile_match_pattern(self, match_rule):
+        if match_rule == "<all_urls>":
+            return "(?:https?|file|ftp)://.*"
+
+        if self.legacy_match_re.search(match_rule):
+            # Regexp syntax is never part of a match pattern, keep matching it from the start of url as before.
+            return self.check_regexp(match_rule, "(?:" + match_rule + ").*")
+
+        match = self.match_pattern_re.match(match_rule)
+        if match is None:
+            # Not a valid match pattern, fall back to glob.
+            return self.compile_glob(match_rule)
+
+        (scheme, host, path) = match.groups()
+        scheme_regexp = "https?" if scheme == "*" else re.escape(scheme)
+        if host is None or host == "*":
+            host_regexp = "[^/]*"
+        elif host.startswith("*."):
+            host_regexp = "(?:[^/]*\\.)?" + re.escape(host[2:])
+        else:
+            host_regexp = re.escape(host)
+        path_regexp = ".*".join(map(re.escape, path.split("*")))
+        return scheme_regexp + "://" + host_regexp + "(?::[0-9]+)?" + path_regexp
+
+    def compile_glob(self, glob):
+        if len(glob) > 1 and glob.startswith("/") and glob.endswith("/"):
+            return self.check_regexp(glob, "(?:" + glob[1:-1] + ")")
+        return ".*".join(map(re.escape, glob.split("*")))
+
+    def check_regexp(self, rule, regexp):
+        ''' Return regexp, or None if rule needs syntax JavaScript RegExp doesn't have. '''
+        if self.python_only_regexp_re.search(regexp):
+            message_to_emacs("Rejected rule {} in {}: not JavaScript regexp syntax.".format(rule, self.filepath))
+            return None
+        return regexp
+
+    def compile_alternation(self, regexps):
+        if len(regexps) == 0:
+            return None
+        return "^(?:" + "|".join(map(lambda regexp: "(?:" + regexp + ")$", regexps)) + ")"
 
-        self.match_rules = match_re.findall(self.file_content)
-        self.export_rules = export_re.findall(self.file_content)
+    def content(self):
+        return self.file_content
 
+    def web_engine_script(self):
+        ''' Return QWebEngineScript of this userscript, it checks url rules itself before running. '''
+        # Invalid regexp throws, script doesn't run then.
+        guard = "if (!(new RegExp({}).test(location.href))) return;".format(
+            json.dumps(self.include_regexp if self.include_regexp is not None else "(?!)"))
+        if self.exclude_regexp is not None:
+            guard += "\nif (new RegExp({}).test(location.href)) return;".format(json.dumps(self.exclude_regexp))
+
+        script = QWebEngineScript()
+        script.setName(TampermonkeyRegistry.script_name_prefix + self.filepath)
+        # Hide metadata block from QtWebEngine, url rules are applied by guard above.
+        script.setSourceCode("(function() {{\n{}\n{}\n}})();".format(
+            guard, self.file_content.replace("==UserScript==", "UserScript")))
+        script.setInjectionPoint(self.injection_points.get(self.run_at, QWebEngineScript.InjectionPoint.DocumentReady))
+        script.setWorldId(QWebEngineScript.ScriptWorldId.ApplicationWorld if self.inject_into == "content" else
+                          QWebEngineScript.ScriptWorldId.MainWorld)
+        script.setRunsOnSubFrames(not self.noframes)
+        return script
+
+class TampermonkeyRegistry():
+    ''' Userscripts of one directory, reloaded only when files change on disk. '''
+
+    registries = {}
+
+    script_name_prefix = "eaf-tampermonkey:"
+
+    @classmethod
+    def get(cls, location):
+        if location not in cls.registries:
+            cls.registries[location] = cls(location)
+        return cls.registries[location]
+
+    def __init__(self, location):
+        self.location = location
+        self.scripts = {}          # filepath -> TampermonkeyScript
+        self.generation = 0        # increased when the script set changes
+        self.installed = {}        # profile -> generation of scripts installed in profile
+
+    def refresh(self):
+        ''' Reparse scripts added or modified since last refresh, raise FileNotFoundError if location is missing. '''
+        changed = False
+        filepaths = set()
+        with os.scandir(self.location) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
 
-    def can_run(self,url):
-        for export_rule in self.export_rules:
-            if re.match(export_rule,url):
-                return False
+                filepaths.add(entry.path)
+                script = self.scripts.get(entry.path)
+                if script is None or script.mtime != entry.stat().st_mtime:
+                    try:
+                        self.scripts[entry.path] = TampermonkeyScript(entry.path)
+                    except (OSError, UnicodeDecodeError) as e:
+                        message_to_emacs("Failed to load {}: {}".format(entry.path, e))
+                        self.scripts.pop(entry.path, None)
+                    changed = True
+
+        for filepath in list(self.scripts.keys()):
+            if filepath not in filepaths:
+                del self.scripts[filepath]
+                changed = True
+
+        if changed:
+            self.generation += 1
+
+    def install(self, profile):
+        ''' Register scripts in profile, only done again after the script set changed. '''
+        if self.installed.get(profile) == self.generation:
+            return
 
-        for match_rule in self.match_rules:
-            if re.match(match_rule,url):
-                return True
+        profile_scripts = profile.scripts()
+        for script in profile_scripts.toList():
+            if script.name().startswith(self.script_name_prefix):
+                profile_scripts.remove(script)
 
-        return False
+        for filepath in sorted(self.scripts.keys()):
+            profile_scripts.insert(self.scripts[filepath].web_engine_script())
 
-    def content(self):
-        return self.file_content
+        self.installed[profile] = self.generation
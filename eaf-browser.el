@@ -118,10 +118,39 @@ If non-nil, all active EAF Browser buffers will be saved before Emacs is killed,
 and will re-open them when calling `eaf-browser-restore-buffers' in the future session."
   :type 'boolean)
 
+(defcustom eaf-browser-restore-lazily nil
+  "If non-nil, `eaf-browser-restore-buffers' creates placeholder buffers.
+
+A placeholder only holds url, title and scroll position of the page,
+the page is loaded when the placeholder is shown in a window."
+  :type 'boolean)
+
+(defcustom eaf-browser-restore-max-concurrent-loads 3
+  "The maximum number of restored pages loading at the same time.
+
+Other placeholders shown in windows wait in a queue."
+  :type 'integer)
+
 (defcustom eaf-browser-fullscreen-move-cursor-corner nil
   "If non-nil, move the mouse cursor to the corner when fullscreen in the browser."
   :type 'boolean)
 
+(defcustom eaf-browser-freeze-hidden-after nil
+  "Seconds after which an EAF Browser buffer not shown in any window is frozen.
+
+A frozen page keeps its memory but runs no timers, animations or scripts,
+so websockets and notifications of the page stop too.
+Pages playing audio are not frozen.  Nil never freezes pages."
+  :type '(choice (const :tag "Never" nil) (integer :tag "Seconds")))
+
+(defcustom eaf-browser-discard-hidden-after nil
+  "Seconds after which an EAF Browser buffer not shown in any window is discarded.
+
+A discarded page releases its renderer memory, it is loaded again at
+its scroll position when the buffer is shown, unsaved form input and
+state of the page are lost.  Nil never discards pages."
+  :type '(choice (const :tag "Never" nil) (integer :tag "Seconds")))
+
 (defcustom eaf-browser-enable-adblocker nil
   "If non-nil, enable adblocker for EAF Browser.
 
@@ -130,12 +159,41 @@ because adblocker will check every url request before send to server.
 Recommand advertisement blocking on the router or proxy."
   :type 'boolean)
 
+(defcustom eaf-browser-adblock-filter-lists
+  '(("easylist.txt" 4))
+  "Filter lists used by the adblocker of EAF Browser.
+
+Each element has the form (SOURCE EXPIRY-DAYS).
+ SOURCE is a path relative to the EAF Browser directory, a file:// url
+  or a http(s) url, remote lists are downloaded and cached.
+ EXPIRY-DAYS is how long a downloaded list is used before updating it,
+  local lists are reloaded when they change.
+
+Lists are compiled in background, and the adblocker switches to the
+new rules once compiling is done.
+
+Element hiding rules (## and #@#) of the lists are applied as
+stylesheets inserted when pages are created, procedural rules are
+not supported."
+  :type '(repeat (list (string :tag "Source") (number :tag "Expiry days"))))
+
+(defcustom eaf-browser-adblock-collect-stats nil
+  "If non-nil, record latency and corpus of every adblock decision.
+
+They are shown in the adblock stats report and saved as benchmark corpus,
+recording costs time on every request, so it's off by default."
+  :type 'boolean)
+
 (defcustom eaf-browser-enable-autofill nil
   "If non-nil, enable autofill password for EAF Browser."
   :type 'boolean)
 
 (defcustom eaf-browser-enable-tampermonkey nil
-  "If non-nil, enable Tampermonkey scripts for EAF Browser."
+  "If non-nil, enable Tampermonkey scripts for EAF Browser.
+
+@match takes match patterns like https://*.example.com/*, @include and
+@exclude take globs or /regexp/.  An @match written as regexp, such as
+https://example.com/video/.*, is still matched as regexp."
   :type 'boolean)
 
 (defcustom eaf-browser-tampermonkey-location ""
@@ -153,6 +211,10 @@ The history file is stored in .emacs.d/eaf/browser/history/log.txt"
   "A list of case insensitive regexp URL to ignore when saving EAF Browser history."
   :type 'cons)
 
+(defcustom eaf-browser-history-search-limit 100
+  "The maximum number of history candidates offered by `eaf-open-browser-with-history'."
+  :type 'integer)
+
 (defcustom eaf-browser-progress-bar-height "2"
   "Set progress bar height for EAF Browser."
   :type 'int)
@@ -206,6 +268,24 @@ Options:
   "Set the chrome history file when exporting chrome history."
   :type 'string)
 
+(defcustom eaf-browser-firefox-history-file ""
+  "Set the firefox places.sqlite file when importing firefox history.
+
+It is usually in ~/.mozilla/firefox/PROFILE/places.sqlite"
+  :type 'string)
+
+(defcustom eaf-browser-history-sync-browsers nil
+  "Browsers whose new history is imported in background periodically.
+
+Possible browsers are \"chrome\" and \"firefox\", history file is read from
+`eaf-browser-chrome-history-file' and `eaf-browser-firefox-history-file'.
+Only visits newer than the last import are read."
+  :type '(repeat string))
+
+(defcustom eaf-browser-history-sync-interval 30
+  "Minutes between two background history imports of `eaf-browser-history-sync-browsers'."
+  :type 'integer)
+
 (defcustom eaf-browser-translate-language ""
   "EAF browser will use current system locale if this option is empty"
   :type 'string)
@@ -379,31 +459,245 @@ Options:
   "The key alias of EAF Browser."
   :type 'cons)
 
+(defun eaf-browser--get-buffer-id ()
+  "Return the buffer id of any live EAF Browser buffer, nil if there is none."
+  (when (eaf-epc-live-p eaf-epc-process)
+    (catch 'found-browser-buffer
+      (eaf-for-each-eaf-buffer
+       (when (string= eaf--buffer-app-name "browser")
+         (throw 'found-browser-buffer eaf--buffer-id))))))
+
+(defvar eaf-browser--config-variables
+  '(eaf-browser-dark-mode
+    eaf-browser-reader-mode-style
+    eaf-browser-ignore-history-list
+    eaf-browser-search-engines
+    eaf-browser-default-search-engine
+    eaf-browser-freeze-hidden-after
+    eaf-browser-discard-hidden-after
+    eaf-browser-adblock-collect-stats)
+  "Variables cached by EAF Browser, new values are pushed to the browser when they change.")
+
+(defun eaf-browser--config-json ()
+  "Return values of `eaf-browser--config-variables' as a json object."
+  (json-encode (mapcar (lambda (symbol) (cons symbol (symbol-value symbol)))
+                       eaf-browser--config-variables)))
+
+(defun eaf-browser--config-variable-watcher (symbol newval operation _where)
+  "Push NEWVAL of SYMBOL to EAF Browser.
+
+Browser reads these variables on every page load and url input,
+so it keeps them instead of asking Emacs each time."
+  (when (eq operation 'set)
+    (let ((buffer-id (eaf-browser--get-buffer-id)))
+      (when buffer-id
+        (eaf-call-async "execute_function_with_args" buffer-id "update_browser_config"
+                        (symbol-name symbol) (json-encode newval))))))
+
+(dolist (symbol eaf-browser--config-variables)
+  (add-variable-watcher symbol #'eaf-browser--config-variable-watcher))
+
+(defvar eaf-browser--visible-buffer-ids nil
+  "Ids of EAF Browser buffers shown in windows, last sent to the browser.")
+
+(defun eaf-browser--push-visible-buffers (&optional _frame)
+  "Tell EAF Browser which buffers are shown, hidden ones are frozen and discarded after idle."
+  (let ((buffer-id (eaf-browser--get-buffer-id))
+        visible-buffer-ids)
+    (when buffer-id
+      (dolist (window (window-list-1 nil 'nomini 'visible))
+        (with-current-buffer (window-buffer window)
+          (when (and (derived-mode-p 'eaf-mode) (string= eaf--buffer-app-name "browser"))
+            (cl-pushnew eaf--buffer-id visible-buffer-ids :test #'equal))))
+      (setq visible-buffer-ids (sort visible-buffer-ids #'string<))
+      (unless (equal visible-buffer-ids eaf-browser--visible-buffer-ids)
+        (setq eaf-browser--visible-buffer-ids visible-buffer-ids)
+        (eaf-call-async "execute_function_with_args" buffer-id "update_visible_buffers" visible-buffer-ids)))))
+
+(add-hook 'window-buffer-change-functions #'eaf-browser--push-visible-buffers)
+
 (defun eaf--browser-update-position (position-percentage)
   "Format mode line position indicator to show the current position in percentage."
   (setq-local mode-line-position `(,position-percentage))
   (force-mode-line-update))
 
+(defun eaf-browser--restore-file-path (filename)
+  "Return path of FILENAME in the history directory of EAF Browser."
+  (concat eaf-config-location
+          (file-name-as-directory "browser")
+          (file-name-as-directory "history")
+          filename))
+
+(defun eaf-browser--save-restore-session ()
+  "Save url, title and position of browser buffers and placeholders to restore.el."
+  (when eaf-browser-continue-where-left-off
+    (let (pages)
+      (dolist (buffer (buffer-list))
+        (with-current-buffer buffer
+          (cond ((eq major-mode 'eaf-browser-placeholder-mode)
+                 (push (list eaf-browser--placeholder-url eaf-browser--placeholder-title
+                             eaf-browser--placeholder-position)
+                       pages))
+                ((and (derived-mode-p 'eaf-mode) (string= eaf--buffer-app-name "browser"))
+                 (push (list eaf--buffer-url (buffer-name)
+                             (when (and (consp mode-line-position) (stringp (car mode-line-position)))
+                               (string-to-number (car mode-line-position))))
+                       pages)))))
+      (make-directory (file-name-directory (eaf-browser--restore-file-path "restore.el")) t)
+      (with-temp-file (eaf-browser--restore-file-path "restore.el")
+        (prin1 (nreverse pages) (current-buffer))))))
+
+;; Run after the hook of EAF that writes restore.txt.
+(add-hook 'kill-emacs-hook #'eaf-browser--save-restore-session 90)
+
+(defun eaf-browser--read-restore-session ()
+  "Return list of (URL TITLE POSITION) of pages to restore.
+
+restore.el also keeps placeholders never loaded, restore.txt only has urls
+of loaded buffers and is used when restore.el doesn't exist."
+  (let ((session-file-path (eaf-browser--restore-file-path "restore.el"))
+        (url-file-path (eaf-browser--restore-file-path "restore.txt")))
+    (if (file-exists-p session-file-path)
+        (with-temp-buffer
+          (insert-file-contents session-file-path)
+          (read (current-buffer)))
+      (mapcar #'list
+              (with-temp-buffer (insert-file-contents url-file-path)
+                                (split-string (buffer-string) "\n" t))))))
+
+(defvar-local eaf-browser--placeholder-url nil
+  "Url of the page restored by placeholder buffer.")
+
+(defvar-local eaf-browser--placeholder-title nil
+  "Title of the page restored by placeholder buffer.")
+
+(defvar-local eaf-browser--placeholder-position nil
+  "Scroll position in percentage of the page restored by placeholder buffer.")
+
+(defvar eaf-browser--restore-queue nil
+  "Placeholder buffers shown in windows and waiting to load.")
+
+(defvar eaf-browser--restore-loading nil
+  "Restored pages that are loading, elements have the form (BUFFER-ID POSITION TIMER).")
+
+(defvar eaf-browser--restore-wait-timer nil
+  "Timer waiting for EAF process to start before loading queued placeholders.")
+
+(defvar eaf-browser-restore-load-timeout 30
+  "Seconds after which a loading restored page stops counting against the concurrent load limit.")
+
+(define-derived-mode eaf-browser-placeholder-mode special-mode "EAF Browser"
+  "Placeholder of a restored EAF Browser page, the page is loaded when it is shown.")
+
+(defun eaf-browser--placeholder-p (buffer)
+  "Return non-nil if BUFFER is a placeholder of a restored page."
+  (eq (buffer-local-value 'major-mode buffer) 'eaf-browser-placeholder-mode))
+
+(defun eaf-browser--create-placeholder (url &optional title position)
+  "Create placeholder buffer of URL with TITLE and scroll POSITION."
+  (with-current-buffer (generate-new-buffer (if (and title (> (length title) 0)) title url))
+    (eaf-browser-placeholder-mode)
+    (setq eaf-browser--placeholder-url url)
+    (setq eaf-browser--placeholder-title title)
+    (setq eaf-browser--placeholder-position position)
+    (let ((inhibit-read-only t))
+      (insert (format "%s\n%s\n\nPage is loaded when this buffer is shown." (or title "") url)))
+    (current-buffer)))
+
+(defun eaf-browser--queue-visible-placeholders (&optional _frame)
+  "Queue placeholders shown in windows, then start loading as many as allowed."
+  (dolist (window (window-list-1 nil 'nomini 'visible))
+    (let ((buffer (window-buffer window)))
+      (when (and (eaf-browser--placeholder-p buffer)
+                 (not (memq buffer eaf-browser--restore-queue)))
+        (setq eaf-browser--restore-queue (append eaf-browser--restore-queue (list buffer))))))
+  (eaf-browser--restore-next))
+
+(defun eaf-browser--restore-wait-process ()
+  "Start EAF process, and load queued placeholders once it is up.
+
+`eaf-open-browser' doesn't create buffer before process is live."
+  (unless eaf-browser--restore-wait-timer
+    (eaf-start-process)
+    (setq eaf-browser--restore-wait-timer
+          (run-with-timer 0.5 0.5
+                          (lambda ()
+                            (when (eaf-epc-live-p eaf-epc-process)
+                              (cancel-timer eaf-browser--restore-wait-timer)
+                              (setq eaf-browser--restore-wait-timer nil)
+                              (eaf-browser--restore-next)))))))
+
+(defun eaf-browser--restore-next ()
+  "Load queued placeholders until `eaf-browser-restore-max-concurrent-loads' pages are loading."
+  (if (not (eaf-epc-live-p eaf-epc-process))
+      (when eaf-browser--restore-queue
+        (eaf-browser--restore-wait-process))
+    (while (and eaf-browser--restore-queue
+                (< (length eaf-browser--restore-loading) eaf-browser-restore-max-concurrent-loads))
+      (let ((placeholder (pop eaf-browser--restore-queue)))
+        (when (buffer-live-p placeholder)
+          (eaf-browser--load-placeholder placeholder)))))
+  (unless (or eaf-browser--restore-queue
+              (memq t (mapcar #'eaf-browser--placeholder-p (buffer-list))))
+    (remove-hook 'window-buffer-change-functions #'eaf-browser--queue-visible-placeholders)))
+
+(defun eaf-browser--load-placeholder (placeholder)
+  "Replace PLACEHOLDER by EAF Browser buffer of its page in windows showing it.
+
+PLACEHOLDER is kept if no browser buffer is created, it is queued again when shown."
+  (let* ((url (buffer-local-value 'eaf-browser--placeholder-url placeholder))
+         (position (buffer-local-value 'eaf-browser--placeholder-position placeholder))
+         (windows (get-buffer-window-list placeholder nil t))
+         (browser-buffer (if windows
+                             (with-selected-window (car windows)
+                               (eaf-open-browser url)
+                               (window-buffer (car windows)))
+                           (save-window-excursion
+                             (eaf-open-browser url)
+                             (current-buffer))))
+         (buffer-id (unless (eq browser-buffer placeholder)
+                      (buffer-local-value 'eaf--buffer-id browser-buffer))))
+    (if (not buffer-id)
+        (message "[EAF/browser] Failed to restore %s." url)
+      (dolist (window (cdr windows))
+        (set-window-buffer window browser-buffer))
+      (kill-buffer placeholder)
+      (push (list buffer-id position
+                  (run-with-timer eaf-browser-restore-load-timeout nil
+                                  #'eaf--browser-first-load-finished buffer-id))
+            eaf-browser--restore-loading))))
+
+(defun eaf--browser-first-load-finished (buffer-id)
+  "Called by EAF Browser when buffer BUFFER-ID finishes its first load."
+  (let ((loading (assoc buffer-id eaf-browser--restore-loading)))
+    (when loading
+      (setq eaf-browser--restore-loading (delq loading eaf-browser--restore-loading))
+      (cancel-timer (nth 2 loading))
+      (when (and (nth 1 loading) (eaf-epc-live-p eaf-epc-process))
+        (eaf-call-async "execute_function_with_args" buffer-id "scroll_to_position_percentage" (nth 1 loading)))
+      (eaf-browser--restore-next))))
+
 (defun eaf-browser-restore-buffers ()
   "EAF restore all opened EAF Browser buffers in the previous Emacs session.
 
-This should be used after setting `eaf-browser-continue-where-left-off' to t."
+This should be used after setting `eaf-browser-continue-where-left-off' to t.
+With `eaf-browser-restore-lazily', pages are restored as placeholders and
+loaded when they are shown."
   (interactive)
   (if eaf-browser-continue-where-left-off
-      (let* ((browser-restore-file-path
-              (concat eaf-config-location
-                      (file-name-as-directory "browser")
-                      (file-name-as-directory "history")
-                      "restore.txt"))
-             (browser-url-list
-              (with-temp-buffer (insert-file-contents browser-restore-file-path)
-                                (split-string (buffer-string) "\n" t))))
-        (if (eaf-epc-live-p eaf-epc-process)
-            (dolist (url browser-url-list)
-              (eaf-open-browser url))
-          (dolist (url browser-url-list)
-            (push `(,url "browser" "") eaf--active-buffers))
-          (when eaf--active-buffers (eaf-open-browser (nth 0 (car eaf--active-buffers))))))
+      (let ((pages (eaf-browser--read-restore-session)))
+        (cond (eaf-browser-restore-lazily
+               (dolist (page pages)
+                 (apply #'eaf-browser--create-placeholder (car page) (cdr page)))
+               (add-hook 'window-buffer-change-functions #'eaf-browser--queue-visible-placeholders)
+               (message "[EAF/browser] Restored %d pages, they are loaded when shown." (length pages)))
+              ((eaf-epc-live-p eaf-epc-process)
+               (dolist (page pages)
+                 (eaf-open-browser (car page))))
+              (t
+               (dolist (page pages)
+                 (push `(,(car page) "browser" "") eaf--active-buffers))
+               (when eaf--active-buffers (eaf-open-browser (nth 0 (car eaf--active-buffers)))))))
     (user-error "Please set `eaf-browser-continue-where-left-off' to t first!")))
 
 (defun eaf--browser-bookmark ()
@@ -542,28 +836,80 @@ If URL is an invalid URL, it will use `eaf-browser-default-search-engine' to sea
 
 This function works best if paired with a fuzzy search package."
   (interactive)
-  (let* ((browser-history-file-path
-          (concat eaf-config-location
-                  (file-name-as-directory "browser")
-                  (file-name-as-directory "history")
-                  "log.txt"))
-         (history-pattern "^\\(.+\\)ᛝ\\(.+\\)ᛡ\\(.+\\)$")
-         (history-file-exists (file-exists-p browser-history-file-path))
+  (let* ((buffer-id (eaf-browser--get-buffer-id))
          (history (completing-read
                    "[EAF/browser] Search || URL || History: "
-                   (if history-file-exists
-                       (mapcar
-                        (lambda (h) (when (string-match history-pattern h)
-                                  (format "[%s] ⇰ %s" (match-string 1 h) (match-string 2 h))))
-                        (with-temp-buffer (insert-file-contents browser-history-file-path)
-                                          (split-string (buffer-string) "\n" t)))
-                     nil)))
+                   (if buffer-id
+                       (eaf-browser--history-completion-table buffer-id)
+                     (eaf-browser--history-file-candidates))))
          (history-url (eaf-is-valid-web-url (when (string-match "⇰\s\\(.+\\)$" history)
                                               (match-string 1 history)))))
     (cond (history-url (eaf-open-browser history-url))
           ((eaf-is-valid-web-url history) (eaf-open-browser history))
           (t (eaf-search-it history)))))
 
+(defun eaf-browser--history-completion-table (buffer-id)
+  "Completion table that searches the history of browser BUFFER-ID as the user types.
+
+The browser process keeps a trigram index of the history, so only the
+best `eaf-browser-history-search-limit' matches are sent back to Emacs.
+Candidates are not filtered again by their prefix, they start with \"[\"
+of the title, see `eaf-browser--history-style-all-completions'."
+  (let ((last-input nil)
+        (last-candidates nil))
+    (lambda (string pred action)
+      (if (eq action 'metadata)
+          '(metadata (category . eaf-browser-history))
+        ;; Only same input reuses the previous search, a longer input may match pages outside of it.
+        (unless (equal string last-input)
+          (setq last-input string)
+          (setq last-candidates
+                (append (json-read-from-string
+                         (eaf-call-sync "execute_function_with_args" buffer-id "search_history"
+                                        string eaf-browser-history-search-limit))
+                        nil)))
+        (let ((candidates (if pred (cl-remove-if-not pred last-candidates) last-candidates)))
+          (cond ((eq action t) candidates)
+                ((eq action 'lambda) (and (member string candidates) t))
+                ((null action) (cond ((null candidates) nil)
+                                     ((equal candidates (list string)) t)
+                                     (t string)))))))))
+
+(defun eaf-browser--history-style-try-completion (string table pred point)
+  "Keep STRING and POINT as they are if TABLE has any history of STRING under PRED."
+  (let ((completion (try-completion string table pred)))
+    (if (stringp completion)
+        (cons string point)
+      completion)))
+
+(defun eaf-browser--history-style-all-completions (string table pred _point)
+  "Return history of whole STRING in TABLE under PRED, without matching their prefix."
+  (all-completions string table pred))
+
+(add-to-list 'completion-styles-alist
+             '(eaf-browser-history
+               eaf-browser--history-style-try-completion
+               eaf-browser--history-style-all-completions
+               "Search EAF Browser history with the whole input."))
+
+(add-to-list 'completion-category-defaults
+             '(eaf-browser-history (styles eaf-browser-history)))
+
+(defun eaf-browser--history-file-candidates ()
+  "Read history candidates from history file, used when no EAF Browser is running."
+  (let ((browser-history-file-path
+         (concat eaf-config-location
+                 (file-name-as-directory "browser")
+                 (file-name-as-directory "history")
+                 "log.txt"))
+        (history-pattern "^\\(.+\\)ᛝ\\(.+\\)ᛡ\\(.+\\)$"))
+    (when (file-exists-p browser-history-file-path)
+      (mapcar
+       (lambda (h) (when (string-match history-pattern h)
+                 (format "[%s] ⇰ %s" (match-string 1 h) (match-string 2 h))))
+       (with-temp-buffer (insert-file-contents browser-history-file-path)
+                         (split-string (buffer-string) "\n" t))))))
+
 (defun eaf--create-search-url (search-string &optional search-engine use-user-engine)
   "Create a search-url for SEARCH-STRING using SEARCH-ENGINE.
 
@@ -651,6 +997,64 @@ Otherwise send key 'esc' to browser."
       (read-only-mode 1))
     (switch-to-buffer eaf-export-text-buffer)))
 
+(defun eaf--browser-show-report (buffer-name report)
+  "Show REPORT text of EAF Browser in buffer BUFFER-NAME."
+  (let ((report-buffer (get-buffer-create buffer-name)))
+    (with-current-buffer report-buffer
+      (read-only-mode -1)
+      (erase-buffer)
+      (insert report)
+      (goto-char (point-min))
+      (read-only-mode 1))
+    (pop-to-buffer report-buffer)))
+
+(defvar eaf-browser-page-load-timeline-columns
+  '(("Time" 8 t)
+    ("Total" 7 eaf-browser--page-load-sort-number)
+    ("First" 7 eaf-browser--page-load-sort-number)
+    ("DCL" 7 eaf-browser--page-load-sort-number)
+    ("Load" 7 eaf-browser--page-load-sort-number)
+    ("Marker" 7 eaf-browser--page-load-sort-number)
+    ("Caret" 6 eaf-browser--page-load-sort-number)
+    ("Autofill" 8 eaf-browser--page-load-sort-number)
+    ("Dark" 6 eaf-browser--page-load-sort-number)
+    ("Scripts" 7 eaf-browser--page-load-sort-number)
+    ("Cosmetic" 8 eaf-browser--page-load-sort-number)
+    ("Blocked" 7 eaf-browser--page-load-sort-number)
+    ("Allowed" 7 eaf-browser--page-load-sort-number)
+    ("Url" 0 t))
+  "Columns of `eaf-browser-page-load-timeline-mode', times are in milliseconds.")
+
+(define-derived-mode eaf-browser-page-load-timeline-mode tabulated-list-mode "EAF Page Loads"
+  "Recent page loads of EAF Browser with time spent in browser hooks."
+  (setq tabulated-list-format (vconcat eaf-browser-page-load-timeline-columns))
+  (setq tabulated-list-sort-key '("Time" . t))
+  (tabulated-list-init-header))
+
+(defun eaf-browser--page-load-sort-number (entry-a entry-b)
+  "Compare ENTRY-A and ENTRY-B by the number of the sorted column, unknown values last."
+  (let* ((column (cl-position (car tabulated-list-sort-key) eaf-browser-page-load-timeline-columns
+                              :key #'car :test #'string=))
+         (value-a (aref (cadr entry-a) column))
+         (value-b (aref (cadr entry-b) column)))
+    (cond ((equal value-b "") (not (equal value-a "")))
+          ((equal value-a "") nil)
+          (t (< (string-to-number value-a) (string-to-number value-b))))))
+
+(defun eaf--browser-show-page-load-timeline (rows-json)
+  "Show ROWS-JSON of EAF Browser page loads in a sortable table."
+  (let ((rows (json-read-from-string rows-json))
+        (index 0))
+    (with-current-buffer (get-buffer-create "*eaf-browser-page-loads*")
+      (eaf-browser-page-load-timeline-mode)
+      (setq tabulated-list-entries
+            (mapcar (lambda (row)
+                      (setq index (1+ index))
+                      (list index row))
+                    rows))
+      (tabulated-list-print)
+      (pop-to-buffer (current-buffer)))))
+
 (defun eaf--browser-render-by-eww (url filepath)
   (eww-open-file filepath)
 